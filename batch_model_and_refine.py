@@ -20,16 +20,30 @@
 
 import os
 import glob
+import fnmatch
 import sys
+import re
+import subprocess
+import threading
+import select
 
 import gtk
+import gobject
 import coot
 import __main__
 
 import time
+import hashlib
+import shutil
+import tempfile
+from collections import OrderedDict
 
 import json
 
+# the job status, statistics and prefetch worker threads only run and may only call gobject.idle_add
+# once threads are initialised; must happen before the first thread starts
+gobject.threads_init()
+
 
 def defaults():
     defaults = {
@@ -51,7 +65,17 @@ def project_data():
             'pdb':                  'refine.pdb',
             'mtz':                  'refine.mtz',
             'mtz_free':             'free.mtz',
-            'ligand_cif':           'ligand_files/*.cif'
+            'ligand_cif':           'ligand_files/*.cif',
+            'cluster_host':         'offline-fe1',
+            'sbatch_command':       'sbatch',
+            'squeue_command':       'squeue',
+            'sacct_command':        'sacct',
+            'job_status_interval':  60,
+            'submission_timeout':   60,
+            'prefetch_depth':       1,
+            'prefetch_budget_mb':   1024,
+            'molecule_pool_size':   5,
+            'molecule_pool_budget_mb':  2048
             },
         'datasets': []
     }
@@ -69,11 +93,25 @@ def dataset_information():
         'ligand_cif':   '',
         'refinement_program':   '',
         'refinement_params':    '',
-        'tag':          ''
+        'tag':          '',
+        'job_id':       None,
+        'job_status':   None,
+        'statistics':   {}
     }
     return dataset
 
 
+def empty_molecule_dict():
+    # imols of the molecules loaded for a dataset
+    mol_dict = {
+        'pdb': None,
+        'mtz': None,
+        'mtz_free': None,
+        'ligand_cif': None
+    }
+    return mol_dict
+
+
 def status_categories():
     status_categories = [
         '-1 - Analysed & Rejected'
@@ -222,75 +260,751 @@ class data_paths(object):
         self.window.destroy()
 
 
+def pdb_header_records():
+    # (record prefix, key, position of the value in line.split())
+    records = [
+        ('REMARK   3   FREE R VALUE                     :', 'r_free', 6),
+        ('REMARK   3   R VALUE     (WORKING + TEST SET) :', 'r_work', 9),
+        ('REMARK   3   RESOLUTION RANGE HIGH (ANGSTROMS) :', 'resolution_high', 7),
+        ('REMARK   3   BOND LENGTHS REFINED ATOMS        (A):', 'rmsd_bonds', 9),
+        ('REMARK   3   BOND ANGLES REFINED ATOMS   (DEGREES):', 'rmsd_angles', 9)
+    ]
+    return records
+
+
+def mmcif_header_items():
+    # mmCIF items written by BUSTER and phenix into refine.cif
+    items = {
+        '_refine.ls_R_factor_R_free':       'r_free',
+        '_refine.ls_R_factor_R_work':       'r_work',
+        '_refine.ls_d_res_high':            'resolution_high',
+        '_symmetry.space_group_name_H-M':   'spacegroup',
+        '_space_group.name_H-M_alt':        'spacegroup'
+    }
+    return items
+
+
+def empty_refinement_record():
+    record = {
+        'spacegroup':       '',
+        'r_free':           '',
+        'r_work':           '',
+        'resolution_high':  '',
+        'rmsd_bonds':       '',
+        'rmsd_angles':      ''
+    }
+    return record
+
+
+def read_pdb_header(pdbFile):
+    """ reads all refinement statistics in one pass and stops at the first coordinate record """
+    record = empty_refinement_record()
+    records = pdb_header_records()
+    with open(pdbFile) as f:
+        for line in f:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                break
+            if line.startswith('CRYST1'):
+                if not record['spacegroup']:
+                    record['spacegroup'] = line[55:65]
+                continue
+            if not line.startswith('REMARK   3'):
+                continue
+            for prefix, key, n in records:
+                if line.startswith(prefix) and not record[key]:
+                    fields = line.split()
+                    if len(fields) > n:
+                        record[key] = fields[n]
+                    break
+    return record
+
+
+def cif_tokens(line):
+    return [t.strip('\'"') for t in re.findall(r"'[^']*'|\"[^\"]*\"|\S+", line)]
+
+
+def read_mmcif_header(cifFile):
+    """ reads the refinement statistics from the _refine, _refine_ls_restr and space group categories of an
+        mmCIF file without parsing coordinates; stops at the _atom_site category
+    """
+    record = empty_refinement_record()
+    items = mmcif_header_items()
+    loop = None
+    values = []
+    rows_seen = False
+    with open(cifFile) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('_atom_site.'):
+                break
+            if not line:
+                continue
+            if line.startswith('#'):
+                loop = None
+                continue
+            if line == 'loop_':
+                loop = []
+                values = []
+                rows_seen = False
+                continue
+            # an item after the first row closes the loop, even without a '#' separator
+            if line.startswith('_') and loop is not None and not values and not rows_seen:
+                loop.append(line.split()[0])
+                continue
+            if loop:
+                if line.startswith('_') or line.startswith('data_'):
+                    loop = None
+                else:
+                    values += cif_tokens(line)
+                    while len(values) >= len(loop):
+                        row = dict(zip(loop, values[:len(loop)]))
+                        values = values[len(loop):]
+                        rows_seen = True
+                        restraint = row.get('_refine_ls_restr.type', '')
+                        deviation = row.get('_refine_ls_restr.dev_ideal', '')
+                        if restraint in ('r_bond_refined_d', 'bond_d', 'f_bond_d', 't_bond_d') and not record['rmsd_bonds']:
+                            record['rmsd_bonds'] = deviation
+                        elif restraint in ('r_angle_refined_deg', 'angle_deg', 'f_angle_d', 't_angle_deg') \
+                                and not record['rmsd_angles']:
+                            record['rmsd_angles'] = deviation
+                    continue
+            loop = None
+            tokens = cif_tokens(line)
+            if len(tokens) >= 2 and tokens[0] in items and not record[items[tokens[0]]]:
+                record[items[tokens[0]]] = tokens[1]
+    return record
+
+
+header_cache = {}
+
+
+def refinement_statistics(fileName, localCopy=None):
+    """ returns the refinement statistics of a PDB or mmCIF file as one record; records are cached by
+        file name, mtime and size, so that they are only read again if the file changed
+        the header is read from localCopy instead if it is given
+    """
+    try:
+        st = os.stat(fileName)
+    except OSError:
+        return empty_refinement_record()
+    cached = header_cache.get(fileName)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+    if fileName.endswith('.cif'):
+        record = read_mmcif_header(localCopy or fileName)
+    else:
+        record = read_pdb_header(localCopy or fileName)
+    header_cache[fileName] = (st.st_mtime, st.st_size, record)
+    return record
+
+
 class pdbtools(object):
-    """ reads refinement statistics from PDB header
+    """ reads refinement statistics from PDB header or refine.cif
         Note: class should be replaced by GEMMI once it is available in WinCOOT
     """
 
-    def __init__(self, pdb, l):
+    def __init__(self, pdb, l=None):
         self.pdb = pdb
-        self.l = l
-        print('here')
-        if os.path.isfile(self.pdb):
-            print('all good')
-        else:
-            print('bummer')
+        self.record = refinement_statistics(pdb)
 
     def spacegroup(self):
-        spacegroup = ''
-        for line in open(self.pdb):
-            if line.startswith('CRYST1'):
-                spacegroup = line[55:65]
-                break
-        return spacegroup
+        return self.record['spacegroup']
 
     def r_free(self):
-        r_free = ''
-        for line in open(self.pdb):
-            if line.startswith('REMARK   3   FREE R VALUE                     :'):
-                r_free = line.split()[6]
-                break
-        return r_free
+        return self.record['r_free']
 
     def r_work(self):
-        r_work = ''
-        for line in open(self.pdb):
-            if line.startswith('REMARK   3   R VALUE     (WORKING + TEST SET) :'):
-                r_work = line.split()[9]
-                break
-        return r_work
+        return self.record['r_work']
 
     def resolution_high(self):
-        resolution_high = ''
-#        for line in open(self.pdb):
-        print('--> self.pdb', self.pdb)
-        if os.path.isfile(self.pdb):
-            print('still all good')
-        else:
-            print('nooooooooooo')
-        print('list', self.l)
-#        for line in open(self.pdb):
-        for line in open(os.sep.join(self.l)):
-            if line.startswith('REMARK   3   RESOLUTION RANGE HIGH (ANGSTROMS) :'):
-                resolution_high = line.split()[7]
-                break
-        return resolution_high
+        return self.record['resolution_high']
 
     def rmsd_bonds(self):
-        rmsd_bonds = ''
-        for line in open(self.pdb):
-            if line.startswith('REMARK   3   BOND LENGTHS REFINED ATOMS        (A):'):
-                rmsd_bonds = line.split()[9]
-                break
-        return rmsd_bonds
+        return self.record['rmsd_bonds']
 
     def rmsd_angles(self):
-        rmsd_angles = ''
-        for line in open(self.pdb):
-            if line.startswith('REMARK   3   BOND ANGLES REFINED ATOMS   (DEGREES):'):
-                rmsd_angles = line.split()[9]
+        return self.record['rmsd_angles']
+
+
+def list_subdirectories(path):
+    """ sorted (name, path) of all directories in path; os.scandir avoids a stat call per entry,
+        python 2 falls back to os.listdir
+    """
+    try:
+        entries = [(e.name, e.path) for e in os.scandir(path) if e.is_dir()]
+    except AttributeError:
+        entries = [(n, os.path.join(path, n)) for n in os.listdir(path) if os.path.isdir(os.path.join(path, n))]
+    except OSError:
+        entries = []
+    return sorted(entries)
+
+
+def matching_files(pattern):
+    # glob only when needed; a plain file name costs one stat call
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    if os.path.exists(pattern):
+        return [pattern]
+    return []
+
+
+def folder_mtimes(sampleDir, patterns):
+    """ mtimes of the sample folder and of the folders that contain the files of the given patterns, as far as
+        their path does not contain wildcards; a new, removed or replaced file changes one of them
+    """
+    folders = set([sampleDir])
+    for pattern in patterns:
+        folder = os.path.dirname(pattern)
+        while glob.has_magic(folder):
+            folder = os.path.dirname(folder)
+        folders.add(folder)
+    mtimes = {}
+    for folder in sorted(folders):
+        try:
+            mtimes[folder] = os.stat(folder).st_mtime
+        except OSError:
+            mtimes[folder] = None
+    return mtimes
+
+
+def dataset_files(dataset):
+    """ (path, is_model) of the model, MTZ and ligand files of a dataset that exist """
+    files = []
+    for key in ('pdb', 'mtz', 'ligand_cif'):
+        fileName = os.sep.join(dataset.get(key) or [])
+        if not fileName:
+            continue
+        files.append((fileName, key == 'pdb'))
+        if key == 'ligand_cif':
+            files.append((fileName.replace('.cif', '.pdb'), False))
+    return [f for f in files if os.path.isfile(f[0])]
+
+
+class prefetcher(object):
+    """ copies the files of the datasets next to the current one into a local cache directory in a worker
+        thread, so that COOT reads them from local disk instead of the network share after navigating;
+        model headers are parsed on the way. The cache is bounded by budget_mb and least recently used
+        files are dropped first, except for the files of the current dataset and its neighbours.
+    """
+
+    def __init__(self, depth=1, budget_mb=1024):
+        self.depth = depth
+        self.budget = budget_mb * 1024 * 1024
+        self.cacheDir = None
+        self.entries = OrderedDict()    # source -> (copy, mtime, size), least recently used first
+        self.size = 0
+        self.pending = []
+        self.protected = set()
+        self.stopped = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.counts = {'hits': 0, 'misses': 0, 'copied': 0}
+
+    def start(self):
+        if self.thread is None:
+            self.cacheDir = tempfile.mkdtemp(prefix='batch_model_and_refine_')
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.wakeup:
+            self.stopped = True
+            self.pending = []
+            self.wakeup.notify()
+        if self.cacheDir is not None:
+            shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def schedule(self, datasets, index):
+        """ replaces everything still pending with the files of the neighbours of index, nearest first """
+        if self.depth <= 0 or self.stopped:
+            return
+        self.start()
+        neighbours = []
+        for step in range(1, self.depth + 1):
+            for i in (index + step, index - step):
+                if 0 <= i < len(datasets):
+                    neighbours.append(datasets[i])
+        pending = []
+        for dataset in neighbours:
+            pending.extend(dataset_files(dataset))
+        protected = set(f[0] for f in pending)
+        if 0 <= index < len(datasets):
+            protected.update(f[0] for f in dataset_files(datasets[index]))
+        with self.wakeup:
+            self.pending = pending
+            self.protected = protected
+            self.wakeup.notify()
+
+    def local_copy(self, source):
+        """ path of the cached copy of source if it is up to date, otherwise source itself """
+        try:
+            st = os.stat(source)
+        except OSError:
+            return source
+        with self.lock:
+            entry = self.entries.get(source)
+            if entry and entry[1] == st.st_mtime and entry[2] == st.st_size and os.path.isfile(entry[0]):
+                self.entries[source] = self.entries.pop(source)
+                self.counts['hits'] += 1
+                return entry[0]
+            self.counts['misses'] += 1
+        return source
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                while not self.pending and not self.stopped:
+                    self.wakeup.wait()
+                if self.stopped:
+                    return
+                source, isModel = self.pending.pop(0)
+            self.fetch(source, isModel)
+
+    def fetch(self, source, isModel):
+        try:
+            st = os.stat(source)
+        except OSError:
+            return
+        with self.lock:
+            entry = self.entries.get(source)
+            if entry and entry[1] == st.st_mtime and entry[2] == st.st_size:
+                self.entries[source] = self.entries.pop(source)
+                return
+        if st.st_size > self.budget:
+            return
+        # one folder per source keeps the file name that COOT shows for the molecule
+        folder = os.path.join(self.cacheDir, hashlib.sha1(source.encode('utf-8')).hexdigest()[:16])
+        copy = os.path.join(folder, os.path.basename(source))
+        try:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+            shutil.copyfile(source, copy + '.tmp')
+            if os.path.exists(copy):
+                # os.rename does not replace existing files on Windows
+                os.remove(copy)
+            os.rename(copy + '.tmp', copy)
+        except (IOError, OSError) as e:
+            if not self.stopped:
+                print('WARNING: prefetch of {0!s} failed: {1!s}'.format(source, e))
+            return
+        if isModel:
+            refinement_statistics(source, copy)
+        with self.lock:
+            if source in self.entries:
+                self.size -= self.entries.pop(source)[2]
+            self.entries[source] = (copy, st.st_mtime, st.st_size)
+            self.size += st.st_size
+            self.counts['copied'] += 1
+            self.evict()
+
+    def evict(self):
+        # called with the lock held
+        for source in list(self.entries):
+            if self.size <= self.budget:
+                break
+            if source in self.protected:
+                continue
+            copy, mtime, size = self.entries.pop(source)
+            self.size -= size
+            try:
+                os.remove(copy)
+            except OSError:
+                pass
+
+    def summary(self):
+        return '{0!s} files prefetched, {1!s} of {2!s} files read from the local cache'.format(
+            self.counts['copied'], self.counts['hits'], self.counts['hits'] + self.counts['misses'])
+
+
+class molecule_pool(object):
+    """ keeps the COOT molecules of the last viewed datasets loaded but hidden, so that going back to one of
+        them neither reads the files nor calculates the maps again; molecules are tracked by comparing
+        molecule_number_list() before and after loading a dataset, so that only molecules opened by the
+        pool are ever closed
+    """
+
+    def __init__(self, size=5, budget_mb=2048):
+        self.size = size
+        self.budget = budget_mb * 1024 * 1024
+        self.entries = OrderedDict()    # key -> {'imols', 'mol_dict', 'files', 'bytes'}, least recently used first
+        self.current = None
+        self.counts = {'hits': 0, 'loads': 0, 'evicted': 0}
+
+    def file_states(self, files):
+        states = {}
+        for fileName in files:
+            try:
+                st = os.stat(fileName)
+                states[fileName] = (st.st_mtime, st.st_size)
+            except OSError:
+                states[fileName] = None
+        return states
+
+    def estimate(self, states):
+        # maps take several times the size of the MTZ they are calculated from
+        total = 0
+        for fileName in states:
+            if states[fileName] is not None:
+                total += states[fileName][1] * (4 if fileName.endswith('.mtz') else 1)
+        return total
+
+    def get(self, key, files):
+        """ mol_dict of key if its model is still loaded and none of its files changed, otherwise None """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        # the user may have closed some of the molecules, e.g. by merging the ligand into the model
+        loaded = set(__main__.molecule_number_list())
+        entry['imols'] = [imol for imol in entry['imols'] if imol in loaded]
+        for item in ('pdb', 'ligand_cif'):
+            if entry['mol_dict'].get(item) not in loaded:
+                entry['mol_dict'][item] = None
+        if entry['mol_dict']['pdb'] is None or entry['files'] != self.file_states(files):
+            self.evict(key)
+            return None
+        self.entries[key] = self.entries.pop(key)
+        self.counts['hits'] += 1
+        return entry['mol_dict']
+
+    def load(self, key, files, loader):
+        """ calls loader, which reads a dataset into COOT and returns its mol_dict, and adds the molecules
+            that appeared in the meantime to the pool
+        """
+        if key in self.entries:
+            self.evict(key)
+        states = self.file_states(files)
+        before = set(__main__.molecule_number_list())
+        try:
+            mol_dict = loader()
+        except Exception:
+            # e.g. an unreadable map; close what was opened so far, so that no hidden molecules are left behind
+            for imol in sorted(set(__main__.molecule_number_list()) - before):
+                coot.close_molecule(imol)
+            raise
+        imols = sorted(set(__main__.molecule_number_list()) - before)
+        self.entries[key] = {'imols': imols, 'mol_dict': mol_dict, 'files': states, 'bytes': self.estimate(states)}
+        self.counts['loads'] += 1
+        return mol_dict
+
+    def show(self, key):
+        """ displays the molecules of key, hides those of all other entries and evicts entries over the limits
+            if key is not in the pool (e.g. it could not be loaded), all entries are hidden
+        """
+        self.current = key
+        for k in self.entries:
+            state = 1 if k == key else 0
+            for imol in self.entries[k]['imols']:
+                coot.set_mol_displayed(imol, state)
+                if coot.is_valid_model_molecule(imol):
+                    coot.set_mol_active(imol, state)
+        for imol in self.entries.get(key, {}).get('imols', []):
+            if coot.is_valid_map_molecule(imol):
+                coot.set_imol_refinement_map(imol)
+                break
+        self.shrink()
+
+    def shrink(self):
+        while len(self.entries) > 1:
+            total = sum(entry['bytes'] for entry in self.entries.values())
+            if len(self.entries) <= self.size and total <= self.budget:
                 break
-        return rmsd_angles
+            self.evict([k for k in self.entries if k != self.current][0])
+
+    def evict(self, key):
+        entry = self.entries.pop(key)
+        loaded = set(__main__.molecule_number_list())
+        for imol in entry['imols']:
+            if imol in loaded:
+                coot.close_molecule(imol)
+        self.counts['evicted'] += 1
+
+    def summary(self):
+        return '{0!s} datasets loaded, {1!s} shown from the pool, {2!s} evicted'.format(
+            self.counts['loads'], self.counts['hits'], self.counts['evicted'])
+
+
+def cluster_path(path):
+    # the project directory is mounted under a different path on the cluster
+    return path.replace('/Volumes/offline-staff', '/data/staff')
+
+
+class shell_transport(object):
+    """ submits batch scripts through one long-lived shell
+        commands are written to the stdin of the shell and every reply ends with a marker line that
+        contains the exit code, so that several sbatch calls can be sent before reading the replies
+        if the shell dies or does not answer within timeout seconds, it is restarted once; sbatch writes its
+        reply to a file next to the script as well, so that jobs that were submitted before the connection
+        was lost are found and not sent again
+    """
+
+    marker = '__batch_model_and_refine_done__'
+
+    def __init__(self, sbatch='sbatch', timeout=60):
+        self.sbatch = sbatch
+        self.timeout = timeout
+        self.process = None
+        self.buffer = ''
+        self.lock = threading.Lock()
+
+    def shell_command(self):
+        return ['bash', '-s']
+
+    def connect(self):
+        print('INFO: opening submission shell: {0!s}'.format(' '.join(self.shell_command())))
+        self.process = subprocess.Popen(self.shell_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, universal_newlines=True)
+        self.buffer = ''
+
+    def close(self, kill=False):
+        if self.process is not None:
+            try:
+                if kill:
+                    # a shell that does not answer may never read its stdin again
+                    self.process.kill()
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+            self.process = None
+
+    def read_line(self):
+        """ next line of output, '' at the end of the output or None if no complete line arrived within
+            timeout seconds
+        """
+        deadline = time.time() + self.timeout
+        stdout = self.process.stdout
+        while '\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                ready = select.select([stdout], [], [], remaining)[0]
+            except (ValueError, OSError, select.error):
+                # pipes cannot be selected on Windows
+                line = self.buffer + stdout.readline()
+                self.buffer = ''
+                return line
+            if not ready:
+                continue
+            data = os.read(stdout.fileno(), 4096)
+            if not isinstance(data, str):
+                data = data.decode('utf-8', 'replace')
+            if not data:
+                line = self.buffer
+                self.buffer = ''
+                return line
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line + '\n'
+
+    def send(self, commands):
+        """ writes all commands at once, then reads one reply per command; returns the list of replies,
+            which is shorter than commands if the shell died on the way
+        """
+        replies = []
+        try:
+            if self.process is None or self.process.poll() is not None:
+                self.connect()
+            for command in commands:
+                # subshell, so that a failing cd does not change the directory of the next command
+                self.process.stdin.write('({0!s}); echo "{1!s} $?"\n'.format(command, self.marker))
+            self.process.stdin.flush()
+            out = []
+            while len(replies) < len(commands):
+                line = self.read_line()
+                if line is None:
+                    print('WARNING: no reply from submission shell within {0!s}s'.format(self.timeout))
+                    self.close(kill=True)
+                    break
+                if not line:
+                    break
+                if line.startswith(self.marker):
+                    replies.append(''.join(out))
+                    out = []
+                else:
+                    out.append(line)
+        except (IOError, OSError) as e:
+            print('WARNING: submission shell failed: {0!s}'.format(e))
+        if len(replies) < len(commands):
+            self.close()
+        return replies
+
+    def run(self, command):
+        """ runs a single command and returns its output, or None if the shell could not be reached """
+        with self.lock:
+            replies = self.send([command])
+            if not replies:
+                replies = self.send([command])
+        if replies:
+            return replies[0]
+        return None
+
+    def submit(self, jobs):
+        """ jobs is a list of (directory, script) tuples; returns a list with the job ID of every job,
+            or None for jobs that could not be submitted
+        """
+        # the reply of sbatch is also written to .<script>.sbatch after a line with the token of this call
+        token = '{0!s}-{1!s}'.format(os.getpid(), time.time())
+        commands = ['cd "{0!s}" && {{ echo "{1!s}"; {2!s} "{3!s}" 2>&1; }} > ".{3!s}.sbatch"; cat ".{3!s}.sbatch"'.format(
+                    directory, token, self.sbatch, script) for directory, script in jobs]
+        with self.lock:
+            replies = self.send(commands)
+            if len(replies) < len(jobs):
+                missing = list(range(len(replies), len(jobs)))
+                replies += [None] * len(missing)
+                print('WARNING: lost connection; checking {0!s} job(s) without reply before resubmitting'.format(
+                    len(missing)))
+                checks = self.send(['cat "{0!s}/.{1!s}.sbatch" 2>/dev/null'.format(jobs[n][0], jobs[n][1])
+                                    for n in missing])
+                resubmit = []
+                unknown = len(missing) - len(checks)
+                for n, check in zip(missing, checks):
+                    if not check.startswith(token + '\n'):
+                        # sbatch was never started for this job
+                        resubmit.append(n)
+                    elif 'Submitted batch job' in check:
+                        replies[n] = check
+                    else:
+                        # sbatch started, but may still submit the job; do not risk a duplicate
+                        unknown += 1
+                if unknown:
+                    print('ERROR: cannot tell whether {0!s} job(s) were submitted; check squeue before resubmitting'.format(
+                        unknown))
+                for n, reply in zip(resubmit, self.send([commands[n] for n in resubmit])):
+                    replies[n] = reply
+        jobIDs = []
+        for n, (directory, script) in enumerate(jobs):
+            jobID = None
+            if replies[n] is not None:
+                reply = replies[n].split(token + '\n', 1)[-1]
+                print(reply.strip())
+                match = re.search(r'Submitted batch job (\d+)', reply)
+                if match:
+                    jobID = match.group(1)
+            if jobID is None:
+                print('ERROR: submission of {0!s} failed'.format(os.path.join(directory, script)))
+            jobIDs.append(jobID)
+        return jobIDs
+
+    def submit_script(self, directory, script):
+        return self.submit([(directory, script)])[0]
+
+
+class ssh_transport(shell_transport):
+    """ runs the submission shell on the cluster front end; the ssh control master keeps the connection
+        open, so that a restarted shell does not need a new handshake
+    """
+
+    def __init__(self, host, sbatch='sbatch', timeout=60):
+        shell_transport.__init__(self, sbatch, timeout)
+        self.host = host
+
+    def shell_command(self):
+        return ['ssh', '-T',
+                '-o', 'BatchMode=yes',
+                '-o', 'ServerAliveInterval=30',
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=~/.ssh/batch_model_and_refine-%r@%h:%p',
+                '-o', 'ControlPersist=10m',
+                self.host, 'bash', '-s']
+
+
+class local_transport(shell_transport):
+    """ runs the submission shell on the local machine, e.g. with a stand-in sbatch script for testing """
+    pass
+
+
+def submission_transport(settings):
+    """ cluster_host 'local' submits on the local machine, everything else through ssh """
+    host = settings.get('cluster_host', 'offline-fe1')
+    sbatch = settings.get('sbatch_command', 'sbatch')
+    timeout = int(settings.get('submission_timeout', 60))
+    if host == 'local':
+        return local_transport(sbatch, timeout)
+    return ssh_transport(host, sbatch, timeout)
+
+
+class job_status_tracker(object):
+    """ keeps the scheduler state of the refinement jobs of all datasets
+        a refresh asks the scheduler once about all unfinished jobs (squeue -j with a job list) and once
+        more for the jobs that already left the queue (sacct); finished jobs are cached and never asked for again
+    """
+
+    queued_states = ['PENDING', 'CONFIGURING', 'REQUEUED', 'RESIZING', 'SUSPENDED']
+    running_states = ['RUNNING', 'COMPLETING', 'STAGE_OUT']
+    done_states = ['COMPLETED']
+
+    def __init__(self, transport, squeue='squeue', sacct='sacct'):
+        self.transport = transport
+        self.squeue = squeue
+        self.sacct = sacct
+        self.jobs = {}
+        self.states = {}
+        self.lock = threading.Lock()
+        self.last_refresh = None
+
+    def track(self, sample_ID, jobID):
+        if jobID:
+            with self.lock:
+                self.jobs[sample_ID] = str(jobID)
+                self.states.setdefault(str(jobID), 'queued')
+
+    def category(self, state):
+        # sacct reports e.g. 'CANCELLED by 1234'
+        state = state.split()[0].rstrip('+') if state else ''
+        if state in self.queued_states:
+            return 'queued'
+        if state in self.running_states:
+            return 'running'
+        if state in self.done_states:
+            return 'done'
+        return 'failed'
+
+    def query(self, command, jobIDs):
+        """ returns a dictionary with the scheduler state of every job ID in the output of command """
+        states = {}
+        out = self.transport.run(command)
+        if out is None:
+            print('WARNING: cannot reach scheduler; keeping previous job states')
+            return None
+        for line in out.splitlines():
+            fields = line.replace('|', ' ').split(None, 1)
+            if len(fields) == 2 and fields[0] in jobIDs:
+                states[fields[0]] = fields[1]
+        return states
+
+    def refresh(self):
+        with self.lock:
+            active = sorted(set(j for j in self.jobs.values() if self.states.get(j) in ('queued', 'running')))
+        if not active:
+            return
+        states = self.query('{0!s} -h -o "%i %T" -j {1!s}'.format(self.squeue, ','.join(active)), active)
+        if states is None:
+            return
+        left = [j for j in active if j not in states]
+        if left:
+            accounting = self.query('{0!s} -n -X -P -o JobID,State -j {1!s}'.format(self.sacct, ','.join(left)), left)
+            if accounting:
+                states.update(accounting)
+        with self.lock:
+            for jobID, state in states.items():
+                self.states[jobID] = self.category(state)
+            self.last_refresh = time.time()
+
+    def status(self, sample_ID):
+        with self.lock:
+            jobID = self.jobs.get(sample_ID)
+            return self.states.get(jobID) if jobID else None
+
+    def summary(self):
+        counts = {'queued': 0, 'running': 0, 'failed': 0, 'done': 0}
+        with self.lock:
+            for jobID in self.jobs.values():
+                counts[self.states.get(jobID, 'queued')] += 1
+        return 'queued: {0!s}  running: {1!s}  failed: {2!s}  done: {3!s}'.format(
+            counts['queued'], counts['running'], counts['failed'], counts['done'])
 
 
 class command_line_scripts(object):
@@ -405,7 +1119,7 @@ class command_line_scripts(object):
         f.close()
 
 
-    def prepare_buster_maxiv_script(self, nextCycle, ligand_cif, projectDir, xtal):
+    def prepare_buster_maxiv_script(self, nextCycle, ligand_cif, projectDir, xtal, transport):
 #        cif_name = ligand_cif.split('/')[len(ligand_cif.split('/'))-1]
         cif_name = "." + ligand_cif.replace(os.path.join(projectDir, xtal), '')
         os.chdir(os.path.join(projectDir, xtal, "scripts"))
@@ -416,7 +1130,6 @@ class command_line_scripts(object):
             '#SBATCH --cpus-per-task=1\n'
             'module load gopresto BUSTER\n'
             'cd {0!s}\n'.format(os.path.join(projectDir, xtal).replace('/Volumes/offline-staff', '/data/staff')) +
-            'touch refinement_in_progress\n'
             'refine' 
             ' -p saved_models/input_model_for_cycle_{0!s}.pdb'.format(nextCycle) +
             ' -m free.mtz'
@@ -427,9 +1140,7 @@ class command_line_scripts(object):
             'ln -s ./Refine_{0!s}/BUSTER_model.cif refine.cif\n'.format(nextCycle) +
             'ln -s ./Refine_{0!s}/BUSTER_refln.cif refine_sf.cif\n'.format(nextCycle) +
             '/data/staff/biomax/tobias/software/MAXIV_tools/pdb_validate_cif.sh -m refine.cif -s refine_sf.cif -o refine_{0!s}\n'.format(nextCycle) +
-            '/data/staff/biomax/tobias/software/MAXIV_tools/table_one.sh -m refine.cif -c process.cif -x xray-report-refine_{0!s}.xml\n'.format(nextCycle) +
-            '/bin/rm refinement_in_progress\n'
-
+            '/data/staff/biomax/tobias/software/MAXIV_tools/table_one.sh -m refine.cif -c process.cif -x xray-report-refine_{0!s}.xml\n'.format(nextCycle)
         )
         print('writing buster_{0!s}.sh in {1!s}'.format(nextCycle, os.path.join(projectDir, xtal, "scripts")))
         f = open('buster_{0!s}.sh'.format(nextCycle), 'w')
@@ -437,14 +1148,14 @@ class command_line_scripts(object):
         f.close()
 
         print('submitting job...')
-        print('ssh offline-fe1 "cd {0!s}; sbatch buster_{1!s}.sh"'.format(os.path.join(projectDir, xtal, "scripts").replace('/Volumes/offline-staff', '/data/staff'), nextCycle))
-        os.system('ssh offline-fe1 "cd {0!s}; sbatch buster_{1!s}.sh"'.format(os.path.join(projectDir, xtal, "scripts").replace('/Volumes/offline-staff', '/data/staff'), nextCycle))
+        return transport.submit_script(cluster_path(os.path.join(projectDir, xtal, "scripts")),
+                                       'buster_{0!s}.sh'.format(nextCycle))
 
 
 #    def prepare_giant_quick_refine_script(self):
 #        cmd = "giant.quick_refine input.pdb=MID2-x0054-ensemble-model.pdb mtz=free.mtz cif=VT00188.cif params=multi-state-restraints.refmac.params"
 
-    def prepare_phenix_maxiv_script(self, nextCycle, ligand_cif, projectDir, xtal):
+    def prepare_phenix_maxiv_script(self, nextCycle, ligand_cif, projectDir, xtal, transport):
         cif_name = "." + ligand_cif.replace(os.path.join(projectDir, xtal), '')
         if not os.path.isdir(os.path.join(projectDir, xtal, "Refine_{0!s}".format(nextCycle))):
             os.mkdir(os.path.join(projectDir, xtal, "Refine_{0!s}".format(nextCycle)))
@@ -455,7 +1166,6 @@ class command_line_scripts(object):
             '#SBATCH --job-name=phenix.refine\n'
             'source /data/staff/biomax/tobias/software/phenix-1.20.1-4487/phenix_env.sh\n'
             'cd {0!s}\n'.format(os.path.join(projectDir, xtal).replace('/Volumes/offline-staff', '/data/staff')) +
-            'touch refinement_in_progress\n'
             'cd Refine_{0!s}\n'.format(nextCycle) +
             'phenix.refine ../saved_models/input_model_for_cycle_{0!s}.pdb'.format(nextCycle) +
             ' ../free.mtz'
@@ -471,9 +1181,7 @@ class command_line_scripts(object):
             'ln -s ./Refine_{0!s}/refine_001.cif refine.cif\n'.format(nextCycle) +
             'ln -s ./Refine_{0!s}/refine_001.reflections.cif refine_sf.cif\n'.format(nextCycle) +
             '/data/staff/biomax/tobias/software/MAXIV_tools/pdb_validate_cif.sh -m refine.cif -s refine_sf.cif -o refine_{0!s}\n'.format(nextCycle) +
-            '/data/staff/biomax/tobias/software/MAXIV_tools/table_one.sh -m refine.cif -c process.cif -x xray-report-refine_{0!s}.xml\n'.format(nextCycle) +
-            '/bin/rm refinement_in_progress\n'
-
+            '/data/staff/biomax/tobias/software/MAXIV_tools/table_one.sh -m refine.cif -c process.cif -x xray-report-refine_{0!s}.xml\n'.format(nextCycle)
         )
         print('writing phenix_{0!s}.sh in {1!s}'.format(nextCycle, os.path.join(projectDir, xtal, "scripts")))
         f = open('phenix_{0!s}.sh'.format(nextCycle), 'w')
@@ -481,8 +1189,8 @@ class command_line_scripts(object):
         f.close()
 
         print('submitting job...')
-        print('ssh offline-fe1 "cd {0!s}; sbatch phenix_{1!s}.sh"'.format(os.path.join(projectDir, xtal, "scripts").replace('/Volumes/offline-staff', '/data/staff'), nextCycle))
-        os.system('ssh offline-fe1 "cd {0!s}; sbatch phenix_{1!s}.sh"'.format(os.path.join(projectDir, xtal, "scripts").replace('/Volumes/offline-staff', '/data/staff'), nextCycle))
+        return transport.submit_script(cluster_path(os.path.join(projectDir, xtal, "scripts")),
+                                       'phenix_{0!s}.sh'.format(nextCycle))
 
 
     def run_refmac_unix_script(self, nextCycle, project_data, xtal):
@@ -507,6 +1215,17 @@ class main_window(object):
 
         self.project_data = project_data()
         self.projectDir = self.project_data['settings']['project_directory']
+        self.transport = None
+        self.job_tracker = None
+        self.job_status_thread = None
+        self.prefetch = None
+        self.molecule_pool = None
+        self.statistics_generation = 0
+        self.statistics_targets = {}
+        self.datasets_by_id = {}
+        self.dataset_positions = {}
+        self.xtal = None
+        self.cb_entries = 0
 
         self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
         self.vbox = gtk.VBox()  # this is the main container
@@ -523,10 +1242,14 @@ class main_window(object):
         self.r_work_label = gtk.Label('')
         self.r_free_label = gtk.Label('')
         self.space_group_label = gtk.Label('')
+        self.job_status_label = gtk.Label('')
+        self.jobs_summary_label = gtk.Label('')
 
 
     def start_gui(self):
         self.window.connect("delete_event", gtk.main_quit)
+        self.window.connect("destroy", self.close_transport)
+        self.window.connect("destroy", self.close_caches)
         self.window.set_border_width(10)
         self.window.set_default_size(400, 600)
         self.window.set_title("Batch model & refine")
@@ -747,6 +1470,8 @@ class main_window(object):
         refine_button.connect("clicked", self.refine)
 #        refine_button.set_sensitive(False)
         vbox.add(refine_button)
+        vbox.add(self.job_status_label)
+        vbox.add(self.jobs_summary_label)
         frame.add(vbox)
         self.vbox.pack_start(frame)
 
@@ -759,6 +1484,9 @@ class main_window(object):
         self.window.add(self.vbox)
         self.window.show_all()
 
+        gobject.timeout_add_seconds(int(self.project_data['settings'].get('job_status_interval', 60)),
+                                    self.poll_job_status)
+
 
     def select_project_directory(self, widget):
         dlg = gtk.FileChooserDialog("Open..", None, gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER,
@@ -792,80 +1520,149 @@ class main_window(object):
         self.project_data['settings'] = data_paths(self.project_data['settings']).start_gui()
 
     def read_datasets(self, widget):
-        globString = self.project_data['settings']['glob_string']
-        pdbName = self.project_data['settings']['pdb']
-        mtzName = self.project_data['settings']['mtz']
-        cifName = self.project_data['settings']['ligand_cif']
+        """ rescans the project directory; sample folders whose directories did not change since the last scan
+            are skipped, new, changed and removed samples are reported
+        """
+        settings = self.project_data['settings']
+        globParts = settings['glob_string'].split(os.sep)
+        # datasets from a loaded or earlier scan, duplicates removed
+        self.datasets_by_id = dict((d['sample_ID'], d) for d in self.project_data['datasets'])
         self.crystal_progressbar.set_fraction(0)
-        n = 0
-        n_folders = len(glob.glob(os.path.join(self.projectDir, globString, pdbName)))
-        for pdbFile in sorted(glob.glob(os.path.join(self.projectDir, globString, pdbName))):
-            if not os.path.isfile(pdbFile):
-                # in case of broken sym links
+        start = time.time()
+        added = []
+        changed = []
+        unchanged = 0
+        found = set()
+        folders = [f for f in list_subdirectories(self.projectDir) if fnmatch.fnmatch(f[0], globParts[0])]
+        for n, (sample_ID, sampleDir) in enumerate(folders):
+            pdbPattern = os.path.join(sampleDir, *(globParts[1:] + [settings['pdb']]))
+            mtzPattern = os.path.join(sampleDir, settings['mtz'])
+            cifPattern = os.path.join(sampleDir, settings['ligand_cif'])
+            mtimes = folder_mtimes(sampleDir, [pdbPattern, mtzPattern, cifPattern])
+            d = self.datasets_by_id.get(sample_ID)
+            if d is not None and d.get('folder_mtimes') == mtimes:
+                found.add(sample_ID)
+                unchanged += 1
                 continue
-#            if os.name == 'nt':
-#                sample_ID = pdbFile.split('\\')[len(self.projectDir.split('\\'))]
-##                sample_ID = pdbFile.split('\\')[len(pdbFile.split('\\'))]
-#            else:
-#                sample_ID = pdbFile.split('/')[len(self.projectDir.split('/'))]
-##                sample_ID = pdbFile.split('/')[len(pdbFile.split('/'))]
-            sample_ID = pdbFile.split(os.sep)[len(self.projectDir.split(os.sep))]
-            print('checking folder: {0!s}'.format(sample_ID))
-            newSample = True
-            for d in self.project_data['datasets']:
-                if sample_ID == d['sample_ID']:
-                    print('sample exists')
-                    datasetDict = d
-                    newSample = False
-                    break
-            if newSample:
-                datasetDict = dataset_information()
-                datasetDict['sample_ID'] = sample_ID
-#            datasetDict['pdb'] = repr(pdbFile)
-            datasetDict['pdb'] = pdbFile.split(os.sep)
-#            print('pdb', datasetDict['pdb'])
-#            print('repr(pdb)', repr(datasetDict['pdb']))
-            for mtzFile in sorted(glob.glob(os.path.join(self.projectDir, sample_ID, mtzName))):
-                print('INFO: found mtz file: {0!s}'.format(mtzFile))
-                datasetDict['mtz'] = mtzFile.split(os.sep)
-#            if os.path.isfile(pdbFile.replace(pdbName, mtzName)):
-#                print('INFO: found mtz file: {0!s}'.format(pdbFile.replace(pdbName, mtzName)))
-#                datasetDict['mtz'] = pdbFile.replace(pdbName, mtzName).split(os.sep)
-#            else:
-#                print('ERROR: cannot find mtz file: {0!s}'.format(pdbFile.replace(pdbName, mtzName)))
-            foundCIF = False
-#            print("cifNamr", cifName)
-#            print("glob",os.path.join(self.projectDir, sample_ID, cifName))
-            for cifFile in glob.glob(os.path.join(self.projectDir, sample_ID, cifName)):
+            pdbFiles = [f for f in matching_files(pdbPattern) if os.path.isfile(f)]
+            if not pdbFiles:
+                # no model (or a broken sym link); removed below if the sample was known before
+                continue
+            found.add(sample_ID)
+            if d is None:
+                d = dataset_information()
+                d['sample_ID'] = sample_ID
+                self.datasets_by_id[sample_ID] = d
+                added.append(sample_ID)
+            else:
+                changed.append(sample_ID)
+            d['folder_mtimes'] = mtimes
+            d['pdb'] = pdbFiles[0].split(os.sep)
+            d['mtz'] = ''
+            for mtzFile in matching_files(mtzPattern):
+                d['mtz'] = mtzFile.split(os.sep)
+            d['ligand_cif'] = ''
+            for cifFile in matching_files(cifPattern):
                 if os.path.isfile(cifFile.replace('.cif', '.pdb')):
-                    datasetDict['ligand_cif'] = cifFile.split(os.sep)
-                    print("found ligand cif and corresponding pdb file: {0!s}".format(cifFile))
-                    foundCIF = True
+                    d['ligand_cif'] = cifFile.split(os.sep)
                     break
-            if not foundCIF:
+            if not d['ligand_cif']:
                 print('WARNING: did not find ligand cif file for {0!s}'.format(sample_ID))
-            self.project_data['datasets'].append((datasetDict))
-#            print('datasetDict', datasetDict)
-            n += 1
-            self.crystal_progressbar.set_fraction(float(n)/float(n_folders))
-        print('INFO: PDB, MTZ, CIF file in project_data:')
-        print(self.project_data)
-        print('INFO: done...')
+            if n % 100 == 0:
+                self.crystal_progressbar.set_fraction(float(n + 1) / float(len(folders)))
+        removed = sorted(set(self.datasets_by_id) - found)
+        for sample_ID in removed:
+            del self.datasets_by_id[sample_ID]
+        self.project_data['datasets'] = [self.datasets_by_id[k] for k in sorted(self.datasets_by_id)]
+        self.dataset_positions = dict((d['sample_ID'], i) for i, d in enumerate(self.project_data['datasets']))
+        print('INFO: scanned {0!s} folders in {1:.1f}s: {2!s} added, {3!s} changed, {4!s} removed, '
+              '{5!s} unchanged'.format(len(folders), time.time() - start, len(added), len(changed), len(removed),
+                                       unchanged))
+        for label, samples in [('added', added), ('changed', changed), ('removed', removed)]:
+            if samples:
+                more = ' ... and {0!s} more'.format(len(samples) - 20) if len(samples) > 20 else ''
+                print('INFO: {0!s}: {1!s}{2!s}'.format(label, ' '.join(samples[:20]), more))
+        if self.index >= 0 and self.xtal in self.dataset_positions:
+            self.index = self.dataset_positions[self.xtal]
+        elif self.index >= len(self.project_data['datasets']):
+            self.index = len(self.project_data['datasets']) - 1
         self.crystal_progressbar.set_fraction(0)
         self.index_label.set_label(str(self.index))
         self.index_total_label.set_label(str(len(self.project_data['datasets'])))
         self.init_crystal_selection_combobox()
-#        for j in range(len(self.project_data['datasets'])):
-#            print(j, self.project_data['datasets'][j]['sample_ID'])
+        self.start_statistics_index()
+
+    def start_statistics_index(self):
+        """ reads the refinement statistics of all datasets in a worker thread; datasets whose PDB file has
+            not changed since the statistics were stored (e.g. in a saved project) are skipped
+        """
+        self.statistics_generation += 1
+        self.statistics_targets = {}
+        datasets = []
+        for d in self.project_data['datasets']:
+            self.statistics_targets[d['sample_ID']] = d
+            datasets.append((d['sample_ID'], os.sep.join(d['pdb']), (d.get('statistics') or {}).get('pdb_mtime')))
+        worker = threading.Thread(target=self.build_statistics_index, args=(self.statistics_generation, datasets))
+        worker.daemon = True
+        worker.start()
+
+    def build_statistics_index(self, generation, datasets):
+        # runs in the worker thread; project_data is only changed in the gtk main loop by apply_statistics
+        batch = []
+        for sample_ID, pdbFile, mtime in datasets:
+            if generation != self.statistics_generation:
+                return
+            try:
+                pdb_mtime = os.stat(pdbFile).st_mtime
+            except OSError:
+                continue
+            if pdb_mtime == mtime:
+                continue
+            statistics = dict(refinement_statistics(pdbFile))
+            statistics['pdb_mtime'] = pdb_mtime
+            batch.append((sample_ID, statistics))
+            if len(batch) == 50:
+                gobject.idle_add(self.apply_statistics, generation, batch, False)
+                batch = []
+        gobject.idle_add(self.apply_statistics, generation, batch, True)
+
+    def apply_statistics(self, generation, batch, finished):
+        if generation != self.statistics_generation:
+            return False
+        for sample_ID, statistics in batch:
+            d = self.statistics_targets.get(sample_ID)
+            if d is not None:
+                d['statistics'] = statistics
+                if self.index >= 0 and d is self.project_data['datasets'][self.index]:
+                    self.show_statistics(statistics)
+        if finished:
+            print('INFO: refinement statistics index complete for {0!s} datasets'.format(
+                len(self.statistics_targets)))
+        return False
+
+    def dataset_statistics(self, d):
+        # from the index if the PDB file did not change since, otherwise read now and store with the dataset
+        pdbFile = os.sep.join(d['pdb'])
+        try:
+            pdb_mtime = os.stat(pdbFile).st_mtime
+        except OSError:
+            pdb_mtime = None
+        if not d.get('statistics') or d['statistics'].get('pdb_mtime') != pdb_mtime:
+            statistics = dict(refinement_statistics(pdbFile))
+            if pdb_mtime is not None:
+                statistics['pdb_mtime'] = pdb_mtime
+            d['statistics'] = statistics
+        return d['statistics']
+
+    def show_statistics(self, statistics):
+        self.resolution_label.set_label(statistics.get('resolution_high', ''))
+        self.r_free_label.set_label(statistics.get('r_free', ''))
+        self.r_work_label.set_label(statistics.get('r_work', ''))
+        self.space_group_label.set_label(statistics.get('spacegroup', ''))
 
     def update_labels(self):
-#        pdb = pdbtools(self.pdb)
-        pdb = pdbtools(self.pdb, self.project_data['datasets'][self.index]['pdb'])
         self.xtal_label.set_label(self.xtal)
-        self.resolution_label.set_label(pdb.resolution_high())
-        self.r_free_label.set_label(pdb.r_free())
-        self.r_work_label.set_label(pdb.r_work())
-        self.space_group_label.set_label(pdb.spacegroup())
+        self.show_statistics(self.dataset_statistics(self.project_data['datasets'][self.index]))
         print('ligand_cif', self.ligand_cif)
 #        if os.name == 'nt':
 #            cif = self.ligand_cif.split('\\')[len(self.ligand_cif.split('\\'))-1].replace('.cif', '')
@@ -888,17 +1685,6 @@ class main_window(object):
 
     def RefreshData(self):
 
-        if len(__main__.molecule_number_list()) > 0:
-            for item in __main__.molecule_number_list():
-                coot.close_molecule(item)
-
-        self.mol_dict = {
-            'pdb': None,
-            'mtz': None,
-            'mtz_free': None,
-            'ligand_cif': None
-            }
-
         if self.index < 0:
             self.index = 0
         if self.index > len(self.project_data['datasets']) - 1:
@@ -914,6 +1700,25 @@ class main_window(object):
 
         self.update_crystal_selection_combobox()
 
+        # recently viewed datasets are still loaded in COOT and only need to be shown again
+        files = [f[0] for f in dataset_files(self.project_data['datasets'][self.index])]
+        pool = self.get_molecule_pool()
+        mol_dict = pool.get(self.pdb, files)
+        if mol_dict is None:
+            try:
+                mol_dict = pool.load(self.pdb, files, self.load_dataset)
+            except Exception as e:
+                print('ERROR: cannot load {0!s}: {1!s}'.format(self.xtal, e))
+                mol_dict = empty_molecule_dict()
+        self.mol_dict = mol_dict
+        pool.show(self.pdb)
+
+        # warm the neighbours while the current dataset is inspected
+        self.get_prefetcher().schedule(self.project_data['datasets'], self.index)
+
+    def load_dataset(self):
+        mol_dict = empty_molecule_dict()
+
         coot.set_nomenclature_errors_on_read("ignore")
 #        print('self.pdb {0!s}'.format(self.pdb))
 #        print('realpath(self.pdb {0!s})'.format(os.path.realpath(self.pdb)))
@@ -923,23 +1728,26 @@ class main_window(object):
 #            print('not sure what it is')
 #        x = os.readlink(self.pdb)
 #        print('x {0!s}'.format(x))
-        imol = coot.handle_read_draw_molecule_with_recentre(self.pdb, 0)
-        self.mol_dict['pdb'] = imol
-        imol = coot.auto_read_make_and_draw_maps(self.mtz)
-        self.mol_dict['mtz'] = imol
+        prefetch = self.get_prefetcher()
+        imol = coot.handle_read_draw_molecule_with_recentre(prefetch.local_copy(self.pdb), 0)
+        mol_dict['pdb'] = imol
+        imol = coot.auto_read_make_and_draw_maps(prefetch.local_copy(self.mtz))
+        mol_dict['mtz'] = imol
 
         if os.path.isfile(self.ligand_cif.replace('.cif', '.pdb')):
 #            print('HHH', self.ligand_cif)
 #            print('ggg', self.ligand_cif.replace(os.path.join(self.projectDir, self.xtal), ''))
-            coot.read_cif_dictionary(self.ligand_cif)
-            imol = coot.handle_read_draw_molecule_with_recentre(self.ligand_cif.replace('.cif', '.pdb'), 0)
-            self.mol_dict['ligand_cif'] = imol
+            coot.read_cif_dictionary(prefetch.local_copy(self.ligand_cif))
+            imol = coot.handle_read_draw_molecule_with_recentre(
+                prefetch.local_copy(self.ligand_cif.replace('.cif', '.pdb')), 0)
+            mol_dict['ligand_cif'] = imol
             coot.seqnum_from_serial_number(imol, "X", 0)
             coot.set_b_factor_residue_range(imol, "X", 1, 1, 20.00)
 
 
         coot.set_colour_map_rotation_on_read_pdb(0)
         coot.set_colour_map_rotation_for_map(0)
+        return mol_dict
 
     def place_ligand_here(self, widget):
         print('===> moving ligand to pointer')
@@ -979,32 +1787,25 @@ class main_window(object):
     def select_crystal(self, widget):
         xtal = str(widget.get_active_text())
         print('new selection: {0!s}'.format(xtal))
-        # self.project_data['datasets'][self.index]['sample_ID']
-        for i in range(len(self.project_data['datasets'])):
-#            print(i, self.project_data['datasets'][i]['sample_ID'])
-            if xtal == self.project_data['datasets'][i]['sample_ID']:
-                self.index = i
-                break
+        if xtal in self.dataset_positions:
+            self.index = self.dataset_positions[xtal]
         self.RefreshData()
 
 
     def update_crystal_selection_combobox(self):
         print('updating crystal selection combobox')
-        for i in range(len(self.project_data['datasets'])):
-            xtal = self.project_data['datasets'][i]['sample_ID']
-            if xtal == self.xtal:
-                self.cb.set_active(i)
-                break
+        if self.xtal in self.dataset_positions:
+            self.cb.set_active(self.dataset_positions[self.xtal])
 
     def init_crystal_selection_combobox(self):
         print('removing all entries from crystal selection combobox')
-        if len(self.project_data['datasets']) != 0:
-            for i in range(len(self.project_data['datasets'])):
-                self.cb.remove_text(0)
+        for i in range(self.cb_entries):
+            self.cb.remove_text(0)
         print('adding new entries from crystal selection combobox')
         for i in range(len(self.project_data['datasets'])):
             xtal = self.project_data['datasets'][i]['sample_ID']
             self.cb.append_text(xtal)
+        self.cb_entries = len(self.project_data['datasets'])
 
     def cancel(self, widget):
         self.window.destroy()
@@ -1034,6 +1835,81 @@ class main_window(object):
     def refinement_parameters_button(self, widget):
         print('hallo')
 
+    def get_transport(self):
+        # one connection for the whole session; opened with the first submission
+        if self.transport is None:
+            self.transport = submission_transport(self.project_data['settings'])
+        return self.transport
+
+    def get_prefetcher(self):
+        settings = self.project_data['settings']
+        depth = int(settings.get('prefetch_depth', 1))
+        budget = int(settings.get('prefetch_budget_mb', 1024))
+        if self.prefetch is None:
+            self.prefetch = prefetcher(depth, budget)
+        else:
+            # a loaded project may come with different settings
+            self.prefetch.depth = depth
+            self.prefetch.budget = budget * 1024 * 1024
+        return self.prefetch
+
+    def get_molecule_pool(self):
+        settings = self.project_data['settings']
+        size = max(1, int(settings.get('molecule_pool_size', 5)))
+        budget = int(settings.get('molecule_pool_budget_mb', 2048))
+        if self.molecule_pool is None:
+            self.molecule_pool = molecule_pool(size, budget)
+        else:
+            self.molecule_pool.size = size
+            self.molecule_pool.budget = budget * 1024 * 1024
+        return self.molecule_pool
+
+    def close_caches(self, widget=None):
+        if self.molecule_pool is not None:
+            print('molecule pool: {0!s}'.format(self.molecule_pool.summary()))
+        if self.prefetch is not None:
+            print('prefetch: {0!s}'.format(self.prefetch.summary()))
+            self.prefetch.stop()
+            self.prefetch = None
+
+    def get_job_tracker(self):
+        if self.job_tracker is None:
+            settings = self.project_data['settings']
+            self.job_tracker = job_status_tracker(self.get_transport(), settings.get('squeue_command', 'squeue'),
+                                                  settings.get('sacct_command', 'sacct'))
+        return self.job_tracker
+
+    def poll_job_status(self):
+        # runs on the gtk timer; the scheduler is asked in a worker thread so that the GUI does not block
+        if self.job_tracker is not None and not self.job_tracker.jobs:
+            return True
+        if self.job_tracker is None or (self.job_status_thread is not None and self.job_status_thread.is_alive()):
+            return True
+        self.job_status_thread = threading.Thread(target=self.refresh_job_status)
+        self.job_status_thread.daemon = True
+        self.job_status_thread.start()
+        return True
+
+    def refresh_job_status(self):
+        self.job_tracker.refresh()
+        gobject.idle_add(self.update_job_status)
+
+    def update_job_status(self):
+        for d in self.project_data['datasets']:
+            status = self.job_tracker.status(d['sample_ID'])
+            if status:
+                d['job_status'] = status
+        if self.index >= 0 and self.project_data['datasets']:
+            sample_ID = self.project_data['datasets'][self.index]['sample_ID']
+            self.job_status_label.set_label('refinement: {0!s}'.format(self.job_tracker.status(sample_ID) or '-'))
+        self.jobs_summary_label.set_label(self.job_tracker.summary())
+        return False
+
+    def close_transport(self, widget=None):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
     def prepare_refinement_batch_script(self, nextCycle):
         print('preparing refinement script...')
         print('chcking if {0!s} exists'.format(os.path.join(self.projectDir, self.xtal, "REFINE_AS_ENSEMBLE")))
@@ -1044,10 +1920,14 @@ class main_window(object):
 #            command_line_scripts.prepare_refmac_unix_script(nextCycle, self.mtz_free, self.ligand_cif, self.project_data, self.xtal)
         if os.path.isfile(os.path.join(self.projectDir, self.xtal, "REFINE_AS_ENSEMBLE")):
             print('running phenix because found {0!s}'.format(os.path.join(self.projectDir, self.xtal, "REFINE_AS_ENSEMBLE")))
-            command_line_scripts().prepare_phenix_maxiv_script(nextCycle, self.ligand_cif, self.projectDir, self.xtal)
+            jobID = command_line_scripts().prepare_phenix_maxiv_script(nextCycle, self.ligand_cif, self.projectDir,
+                                                                       self.xtal, self.get_transport())
         else:
             print('no ensemble refinement; running buster...')
-            command_line_scripts().prepare_buster_maxiv_script(nextCycle, self.ligand_cif, self.projectDir, self.xtal)
+            jobID = command_line_scripts().prepare_buster_maxiv_script(nextCycle, self.ligand_cif, self.projectDir,
+                                                                       self.xtal, self.get_transport())
+        print('INFO: job ID of refinement: {0!s}'.format(jobID))
+        return jobID
 
     def remove_files_from_previous_cycle(self):
         os.chdir(os.path.join(self.projectDir, self.xtal))
@@ -1085,7 +1965,12 @@ class main_window(object):
         pdbin = "input_model_for_cycle_{0!s}.pdb".format(nextCycle)
         self.save_model_to_saved_models_folder(pdbin)
 
-        self.prepare_refinement_batch_script(nextCycle)
+        jobID = self.prepare_refinement_batch_script(nextCycle)
+        if jobID:
+            self.project_data['datasets'][self.index]['job_id'] = jobID
+            self.project_data['datasets'][self.index]['job_status'] = 'queued'
+            self.get_job_tracker().track(self.xtal, jobID)
+            self.update_job_status()
 
 #        self.run_refinement_batch_script(nextCycle)
 
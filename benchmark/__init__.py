@@ -0,0 +1 @@
+# synthetic fragment-screening campaigns and timing of the file discovery and analysis code paths
@@ -0,0 +1,149 @@
+# Copyright (c) 2022, Tobias Krojer, MAX IV Laboratory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import getopt
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run_initial_refinement
+from make_campaign import make_campaign
+
+
+def stub_dimple(binDir, failFile, callsFile):
+    os.makedirs(binDir)
+    with open(os.path.join(binDir, 'dimple'), 'w') as f:
+        f.write(
+            '#!/bin/bash\n'
+            'sample=$(basename "$PWD")\n'
+            'echo "$sample" >> {1!s}\n'
+            '[ "$sample" = "$(cat {0!s} 2>/dev/null)" ] && exit 3\n'
+            'exit 0\n'.format(failFile, callsFile)
+        )
+    os.chmod(os.path.join(binDir, 'dimple'), 0o755)
+
+
+def run(processDir, projectDir, pdbDir, callsFile):
+    """ returns the samples for which dimple was called and the manifest after the run """
+    if os.path.isfile(callsFile):
+        os.remove(callsFile)
+    run_initial_refinement.mtzCache = run_initial_refinement.mtz_header_cache()
+    run_initial_refinement.run_initial_refinement(processDir, projectDir, pdbDir, None, 'dimple', False,
+                                                  backend=run_initial_refinement.local_backend(2))
+    calls = []
+    if os.path.isfile(callsFile):
+        with open(callsFile) as f:
+            calls = sorted(f.read().split())
+    with open(os.path.join(projectDir, 'initial_refinement_manifest.json')) as f:
+        samples = json.load(f)['samples']
+    return calls, samples
+
+
+def check(errors, condition, message):
+    print('{0!s}: {1!s}'.format('OK' if condition else 'FAILED', message))
+    if not condition:
+        errors.append(message)
+
+
+def check_manifest(workDir, n_samples):
+    """ runs the local backend three times on a synthetic campaign; a stub dimple on PATH fails for one sample
+        in the first run, so that only this sample has to be submitted again in the second run
+    """
+    processDir, pdbDir, projectDir = make_campaign(os.path.join(workDir, 'campaign'), n_samples)
+    binDir = os.path.join(workDir, 'bin')
+    failFile = os.path.join(workDir, 'fail')
+    callsFile = os.path.join(workDir, 'dimple.calls')
+    stub_dimple(binDir, failFile, callsFile)
+    os.environ['PATH'] = binDir + os.pathsep + os.environ.get('PATH', '')
+    samples = sorted(os.listdir(processDir))
+    failed = samples[0]
+    with open(failFile, 'w') as f:
+        f.write(failed)
+
+    errors = []
+    calls, manifest = run(processDir, projectDir, pdbDir, callsFile)
+    check(errors, calls == samples, 'first run submits every sample')
+    check(errors, manifest[failed].get('exit_code') == 3, 'exit code of the failed job is recorded')
+
+    os.remove(failFile)
+    calls, manifest = run(processDir, projectDir, pdbDir, callsFile)
+    check(errors, calls == [failed], 'second run only resubmits the failed sample')
+    check(errors, manifest[failed].get('exit_code') == 0, 'exit code of the resubmitted job is recorded')
+
+    calls, manifest = run(processDir, projectDir, pdbDir, callsFile)
+    check(errors, calls == [], 'third run does not submit anything')
+    return errors
+
+
+def usage():
+    usage = (
+        '\n'
+        'usage:\n'
+        'ccp4-python benchmark/check_manifest.py\n'
+        '\n'
+        'additional command line options:\n'
+        '--samples, -n\n'
+        '    number of samples (default: 5)\n'
+        '--workdir, -w\n'
+        '    directory for the synthetic campaign (must not exist; default: temporary directory)\n'
+    )
+    print(usage)
+
+
+def main(argv):
+    n_samples = 5
+    workDir = None
+
+    try:
+        opts, args = getopt.getopt(argv, "n:w:h", ["samples=", "workdir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-n", "--samples"):
+            n_samples = int(arg)
+        elif opt in ("-w", "--workdir"):
+            workDir = arg
+
+    cleanup = workDir is None
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix='bmr_check_')
+    try:
+        errors = check_manifest(workDir, n_samples)
+    finally:
+        if cleanup:
+            shutil.rmtree(workDir)
+    if errors:
+        print('ERROR: {0!s} checks failed'.format(len(errors)))
+        sys.exit(1)
+    print('INFO: all checks passed')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,242 @@
+# Copyright (c) 2022, Tobias Krojer, MAX IV Laboratory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import ast
+import getopt
+import glob
+import os
+import re
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run_initial_refinement
+from check_manifest import check
+
+
+def write_stub(binDir, name, body):
+    if not os.path.isdir(binDir):
+        os.makedirs(binDir)
+    with open(os.path.join(binDir, name), 'w') as f:
+        f.write('#!/bin/bash\n' + body)
+    os.chmod(os.path.join(binDir, name), 0o755)
+
+
+def read_lines(filename):
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as f:
+        return f.read().splitlines()
+
+
+def load_plugin_classes(names):
+    """ the plugin can only be imported inside COOT; the submission classes do not need it and are
+        compiled on their own
+    """
+    pluginFile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'batch_model_and_refine.py')
+    with open(pluginFile) as f:
+        tree = ast.parse(f.read())
+    tree.body = [node for node in tree.body if getattr(node, 'name', None) in names]
+    namespace = {'os': os, 're': re, 'select': select, 'subprocess': subprocess, 'threading': threading,
+                 'time': time}
+    exec(compile(tree, pluginFile, 'exec'), namespace)
+    return namespace
+
+
+def check_array_submission(workDir, errors):
+    """ all samples go to the scheduler with one sbatch --array call; task N of the array runs sample N """
+    binDir = os.path.join(workDir, 'array_bin')
+    callsFile = os.path.join(workDir, 'array_sbatch.calls')
+    write_stub(binDir, 'sbatch', 'echo "$@" >> {0!s}\necho "Submitted batch job 4711"\n'.format(callsFile))
+    projectDir = os.path.join(workDir, 'array_project')
+    samples = ['sample-{0!s}'.format(n) for n in range(5)]
+    for sample in samples:
+        os.makedirs(os.path.join(projectDir, sample))
+    path = os.environ['PATH']
+    os.environ['PATH'] = binDir + os.pathsep + path
+    try:
+        backend = run_initial_refinement.slurm_backend(array=True, throttle=2)
+        for sample in samples:
+            backend.submit(projectDir, sample, 'dimple')
+        calls = read_lines(callsFile)
+        check(errors, calls == [], 'array backend does not call sbatch before finish')
+        records = backend.finish(projectDir, 'dimple')
+    finally:
+        os.environ['PATH'] = path
+    calls = read_lines(callsFile)
+    check(errors, len(calls) == 1, 'one sbatch call for {0!s} samples'.format(len(samples)))
+    check(errors, bool(calls) and calls[0].startswith('--array=0-4%2 '), 'array of 5 tasks throttled to 2')
+    check(errors, [records[sample]['job_id'] for sample in samples] == ['4711_{0!s}'.format(n) for n in range(5)],
+          'every sample gets the array task ID of its line in the task list')
+    taskFiles = glob.glob(os.path.join(projectDir, 'init_refine_tasks_*.txt'))
+    tasks = read_lines(taskFiles[0]) if taskFiles else []
+    check(errors, [line.split('\t')[0] for line in tasks] == [os.path.join(projectDir, s) for s in samples],
+          'task list maps array index to sample directory')
+
+
+def check_lost_connection(workDir, errors):
+    """ the stub sbatch kills the submission shell right after submitting the second job; the transport has to
+        find that job in its reply file and must only send the jobs again that never reached sbatch
+    """
+    plugin = load_plugin_classes(['cluster_path', 'shell_transport', 'ssh_transport', 'local_transport',
+                                  'submission_transport'])
+    callsFile = os.path.join(workDir, 'transport_sbatch.calls')
+    pidFile = os.path.join(workDir, 'transport_shell.pid')
+    sbatch = os.path.join(workDir, 'transport_bin', 'sbatch')
+    write_stub(os.path.dirname(sbatch), 'sbatch', (
+        'echo "$1" >> {0!s}\n'
+        'echo "Submitted batch job $(wc -l < {0!s})"\n'
+        'if [ "$1" = second.sh ] && [ -e {1!s} ]; then\n'
+        '    kill -9 $(cat {1!s}); rm {1!s}\n'
+        'fi\n').format(callsFile, pidFile))
+    jobDir = os.path.join(workDir, 'transport_jobs')
+    os.makedirs(jobDir)
+    transport = plugin['submission_transport']({'cluster_host': 'local', 'sbatch_command': sbatch,
+                                                'submission_timeout': 10})
+    transport.connect()
+    with open(pidFile, 'w') as f:
+        f.write(str(transport.process.pid))
+    scripts = ['first.sh', 'second.sh', 'third.sh', 'fourth.sh']
+    try:
+        jobIDs = transport.submit([(jobDir, script) for script in scripts])
+    finally:
+        transport.close()
+    calls = read_lines(callsFile)
+    check(errors, not os.path.isfile(pidFile), 'submission shell was killed during the submission')
+    check(errors, sorted(calls) == sorted(scripts), 'every script was passed to sbatch exactly once')
+    check(errors, all(jobIDs) and len(set(jobIDs)) == len(scripts), 'every job has its own job ID')
+
+
+def check_job_tracking(workDir, errors):
+    """ a refresh asks squeue once for all unfinished jobs and sacct once for the jobs that left the queue,
+        independent of the number of jobs
+    """
+    plugin = load_plugin_classes(['cluster_path', 'shell_transport', 'local_transport', 'job_status_tracker'])
+    binDir = os.path.join(workDir, 'scheduler_bin')
+    callsFile = os.path.join(workDir, 'scheduler.calls')
+    # job IDs divisible by 3 are running, those with remainder 1 pending; the others have finished and are
+    # completed if even and failed if odd
+    write_stub(binDir, 'squeue', (
+        'echo squeue >> {0!s}\n'
+        'list=${{@: -1}}\n'
+        'for j in ${{list//,/ }}; do\n'
+        '    [ $((j % 3)) = 0 ] && echo "$j RUNNING"\n'
+        '    [ $((j % 3)) = 1 ] && echo "$j PENDING"\n'
+        'done\n'
+        'exit 0\n').format(callsFile))
+    write_stub(binDir, 'sacct', (
+        'echo sacct >> {0!s}\n'
+        'list=${{@: -1}}\n'
+        'for j in ${{list//,/ }}; do\n'
+        '    [ $((j % 2)) = 0 ] && echo "$j|COMPLETED" || echo "$j|FAILED"\n'
+        '    echo "$j.batch|COMPLETED"\n'
+        'done\n').format(callsFile))
+    for n_jobs in [10, 5000]:
+        if os.path.isfile(callsFile):
+            os.remove(callsFile)
+        transport = plugin['local_transport']()
+        tracker = plugin['job_status_tracker'](transport, os.path.join(binDir, 'squeue'),
+                                               os.path.join(binDir, 'sacct'))
+        expected = {'queued': 0, 'running': 0, 'failed': 0, 'done': 0}
+        for jobID in range(1000, 1000 + n_jobs):
+            tracker.track('sample-{0!s}'.format(jobID), jobID)
+            if jobID % 3 == 0:
+                expected['running'] += 1
+            elif jobID % 3 == 1:
+                expected['queued'] += 1
+            else:
+                expected['done' if jobID % 2 == 0 else 'failed'] += 1
+        try:
+            tracker.refresh()
+            first = read_lines(callsFile)
+            tracker.refresh()
+            second = read_lines(callsFile)[len(first):]
+        finally:
+            transport.close()
+        check(errors, first == ['squeue', 'sacct'], '{0!s} jobs - one squeue and one sacct call'.format(n_jobs))
+        check(errors, second == ['squeue'], '{0!s} jobs - finished jobs are not queried again'.format(n_jobs))
+        check(errors, tracker.summary() == 'queued: {0!s}  running: {1!s}  failed: {2!s}  done: {3!s}'.format(
+            expected['queued'], expected['running'], expected['failed'], expected['done']),
+              '{0!s} jobs - {1!s}'.format(n_jobs, tracker.summary()))
+        check(errors, tracker.status('sample-1001') == 'failed' and tracker.status('sample-1004') == 'done',
+              '{0!s} jobs - state of single datasets'.format(n_jobs))
+
+
+def usage():
+    usage = (
+        '\n'
+        'usage:\n'
+        'ccp4-python benchmark/check_submission.py\n'
+        '\n'
+        'checks Slurm array submission, the submission shell of the COOT plugin and its job status tracker\n'
+        'with stand-in sbatch, squeue and sacct scripts\n'
+        '\n'
+        'additional command line options:\n'
+        '--workdir, -w\n'
+        '    directory for stub scripts and job folders (must not exist; default: temporary directory)\n'
+    )
+    print(usage)
+
+
+def main(argv):
+    workDir = None
+
+    try:
+        opts, args = getopt.getopt(argv, "w:h", ["workdir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-w", "--workdir"):
+            workDir = arg
+
+    cleanup = workDir is None
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix='bmr_check_')
+    else:
+        os.makedirs(workDir)
+    errors = []
+    try:
+        for checks in [check_array_submission, check_lost_connection, check_job_tracking]:
+            print('>>> {0!s}'.format(checks.__name__))
+            checks(workDir, errors)
+    finally:
+        if cleanup:
+            shutil.rmtree(workDir)
+    if errors:
+        print('ERROR: {0!s} checks failed'.format(len(errors)))
+        sys.exit(1)
+    print('INFO: all checks passed')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,214 @@
+# Copyright (c) 2022, Tobias Krojer, MAX IV Laboratory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import getopt
+import sys
+import os
+import random
+import gemmi
+import numpy as np
+
+
+def crystal_forms():
+    # space group and unit cell of the reference models; samples are generated around these cells
+    forms = [
+        ['P 21 21 21', [52.3, 61.7, 71.9, 90.0, 90.0, 90.0]],
+        ['C 1 2 1', [101.2, 58.4, 67.3, 90.0, 112.5, 90.0]],
+        ['P 61 2 2', [88.1, 88.1, 124.6, 90.0, 90.0, 120.0]]
+    ]
+    return forms
+
+
+def write_mtz(mtzfile, space_group, unitcell, resolution_high, n_reflections=50):
+    """ writes a small MTZ file; only reflections close to resolution_high are kept, so that the header
+        resolution is realistic while the file stays a few kB
+    """
+    mtz = gemmi.Mtz(with_base=True)
+    mtz.spacegroup = gemmi.find_spacegroup_by_name(space_group)
+    mtz.set_cell_for_all(gemmi.UnitCell(*unitcell))
+    mtz.add_dataset('synthetic')
+    mtz.add_column('F', 'F')
+    mtz.add_column('SIGF', 'Q')
+    mtz.add_column('FreeR_flag', 'I')
+    hkl = gemmi.make_miller_array(mtz.cell, mtz.spacegroup, resolution_high, resolution_high + 0.5)[:n_reflections]
+    data = np.column_stack([hkl, np.ones((len(hkl), 2)), np.zeros((len(hkl), 1))]).astype(np.float32)
+    mtz.set_data(data)
+    mtz.update_reso()
+    mtz.write_to_file(mtzfile)
+
+
+def write_pdb(pdbfile, space_group, unitcell):
+    structure = gemmi.Structure()
+    structure.cell = gemmi.UnitCell(*unitcell)
+    structure.spacegroup_hm = space_group
+    model = gemmi.Model('1')
+    chain = gemmi.Chain('A')
+    for n in range(10):
+        residue = gemmi.Residue()
+        residue.name = 'ALA'
+        residue.seqid = gemmi.SeqId(n + 1, ' ')
+        atom = gemmi.Atom()
+        atom.name = 'CA'
+        atom.element = gemmi.Element('C')
+        atom.pos = gemmi.Position(3.8 * n, 0.0, 0.0)
+        atom.occ = 1.0
+        atom.b_iso = 20.0
+        residue.add_atom(atom)
+        chain.add_residue(residue)
+    model.add_chain(chain)
+    structure.add_model(model)
+    structure.setup_entities()
+    structure.write_pdb(pdbfile)
+
+
+def aimless_log(completeness, isigma):
+    log = (
+        '                                           Overall  InnerShell  OuterShell\n'
+        'Completeness                              {0:5.1f}      {1:5.1f}      {2:5.1f}\n'.format(
+            completeness, 99.9, completeness - 10) +
+        'Mean((I)/sd(I))                           {0:5.1f}      {1:5.1f}      {2:5.1f}\n'.format(
+            isigma, isigma * 3, 1.5)
+    )
+    return log
+
+
+def dials_log(completeness, isigma):
+    log = (
+        '                             Overall    Low     High\n'
+        'Completeness                 {0:5.1f}    99.9    {1:5.1f}\n'.format(completeness, completeness - 10) +
+        'Mean I/sigma(I)              {0:5.1f}    {1:5.1f}     1.5\n'.format(isigma, isigma * 3)
+    )
+    return log
+
+
+def make_run(runDir, space_group, unitcell, rng, missing_log):
+    autoproc = os.path.join(runDir, 'autoPROC', 'cn{0!s}_20221113-101010'.format(rng.randint(10, 99)),
+                            'AutoPROCv1_0_anom')
+    os.makedirs(os.path.join(autoproc, 'HDF5_1'))
+    dials = os.path.join(runDir, 'xia2DIALS', 'cn{0!s}_20221113-101212'.format(rng.randint(10, 99)),
+                         'Xia2DIALSv1_0_anom')
+    os.makedirs(os.path.join(dials, 'DataFiles'))
+    os.makedirs(os.path.join(dials, 'LogFiles'))
+    resolution = round(rng.uniform(1.2, 2.8), 2)
+    write_mtz(os.path.join(autoproc, 'HDF5_1', 'truncate-unique.mtz'), space_group, unitcell, resolution)
+    write_mtz(os.path.join(autoproc, 'HDF5_1', 'staraniso_alldata-unique.mtz'), space_group, unitcell,
+              round(resolution - 0.15, 2))
+    write_mtz(os.path.join(dials, 'DataFiles', 'AUTOMATIC_DEFAULT_free.mtz'), space_group, unitcell,
+              round(resolution + 0.05, 2))
+    for cif in ['Data_2_autoPROC_TRUNCATE_all.cif', 'Data_1_autoPROC_STARANISO_all.cif']:
+        with open(os.path.join(autoproc, cif), 'w') as f:
+            f.write('data_synthetic\n')
+    with open(os.path.join(dials, 'DataFiles', 'xia2.mmcif.bz2'), 'wb') as f:
+        f.write(b'')
+    if not missing_log:
+        with open(os.path.join(autoproc, 'HDF5_1', 'aimless.log'), 'w') as f:
+            f.write(aimless_log(rng.uniform(90, 100), rng.uniform(5, 25)))
+        with open(os.path.join(autoproc, 'HDF5_1', 'staraniso_alldata.log'), 'w') as f:
+            f.write(aimless_log(rng.uniform(85, 95), rng.uniform(5, 25)))
+        with open(os.path.join(dials, 'LogFiles', 'AUTOMATIC_DEFAULT_SCALE.log'), 'w') as f:
+            f.write(dials_log(rng.uniform(90, 100), rng.uniform(5, 25)))
+
+
+def make_project_sample(sampleDir, space_group, unitcell, broken_link):
+    os.makedirs(os.path.join(sampleDir, 'ligand_files'))
+    if broken_link:
+        os.symlink(os.path.join(sampleDir, 'Refine_1', 'refine.pdb'), os.path.join(sampleDir, 'refine.pdb'))
+    else:
+        write_pdb(os.path.join(sampleDir, 'refine.pdb'), space_group, unitcell)
+    write_mtz(os.path.join(sampleDir, 'refine.mtz'), space_group, unitcell, 2.0)
+    with open(os.path.join(sampleDir, 'ligand_files', 'LIG.cif'), 'w') as f:
+        f.write('data_comp_LIG\n')
+    with open(os.path.join(sampleDir, 'ligand_files', 'LIG.pdb'), 'w') as f:
+        f.write('HETATM    1  C1  LIG X   1       0.000   0.000   0.000  1.00 20.00           C\nEND\n')
+
+
+def make_campaign(campaignDir, n_samples, seed=0, broken_fraction=0.02, missing_log_fraction=0.05):
+    """ creates campaignDir/process (auto-processing results), campaignDir/pdb (reference models) and
+        campaignDir/project (refined datasets as read by batch_model_and_refine.py)
+        returns the three directories
+    """
+    rng = random.Random(seed)
+    processDir = os.path.join(campaignDir, 'process')
+    pdbDir = os.path.join(campaignDir, 'pdb')
+    projectDir = os.path.join(campaignDir, 'project')
+    for d in [processDir, pdbDir, projectDir]:
+        os.makedirs(d)
+    forms = crystal_forms()
+    for n, (space_group, unitcell) in enumerate(forms):
+        write_pdb(os.path.join(pdbDir, 'reference_{0!s}.pdb'.format(n + 1)), space_group, unitcell)
+    for n in range(n_samples):
+        sample = 'protein-x{0:05d}'.format(n + 1)
+        space_group, reference_cell = forms[rng.randrange(len(forms))]
+        unitcell = [p * rng.uniform(0.99, 1.01) for p in reference_cell[:3]] + reference_cell[3:]
+        for run in range(1 + (rng.random() < 0.2)):
+            runDir = os.path.join(processDir, sample, 'xds_{0!s}_{1!s}_1'.format(sample, run + 1))
+            make_run(runDir, space_group, unitcell, rng, rng.random() < missing_log_fraction)
+        make_project_sample(os.path.join(projectDir, sample), space_group, unitcell, rng.random() < broken_fraction)
+    return processDir, pdbDir, projectDir
+
+
+def usage():
+    usage = (
+        '\n'
+        'usage:\n'
+        'ccp4-python benchmark/make_campaign.py -o <campaign_dir> -n <number_of_samples>\n'
+        '\n'
+        'additional command line options:\n'
+        '--output, -o\n'
+        '    directory for the synthetic campaign (must not exist)\n'
+        '--samples, -n\n'
+        '    number of samples (default: 100)\n'
+        '--seed, -s\n'
+        '    random seed (default: 0)\n'
+    )
+    print(usage)
+
+
+def main(argv):
+    campaignDir = None
+    n_samples = 100
+    seed = 0
+
+    try:
+        opts, args = getopt.getopt(argv, "o:n:s:h", ["output=", "samples=", "seed="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-o", "--output"):
+            campaignDir = arg
+        elif opt in ("-n", "--samples"):
+            n_samples = int(arg)
+        elif opt in ("-s", "--seed"):
+            seed = int(arg)
+
+    if not campaignDir:
+        usage()
+        sys.exit(2)
+    processDir, pdbDir, projectDir = make_campaign(campaignDir, n_samples, seed)
+    print('INFO: created {0!s} samples in {1!s}'.format(n_samples, campaignDir))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,210 @@
+# Copyright (c) 2022, Tobias Krojer, MAX IV Laboratory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import getopt
+import glob
+import sys
+import os
+import json
+import time
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run_initial_refinement
+from make_campaign import make_campaign
+
+
+def timed(stages, stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    stages[stage] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def discover_all(sample_folders):
+    candidates = {}
+    fsCalls = 0
+    for sample_folder in sample_folders:
+        candidates[sample_folder], n = run_initial_refinement.discover_sample(sample_folder)
+        fsCalls += n
+    return candidates, fsCalls
+
+
+def analyse_all_mtz(candidates):
+    for sample_candidates in candidates.values():
+        for candidate in sample_candidates:
+            run_initial_refinement.mtz_info(candidate['mtz'])
+
+
+def match_references(candidates, pdbDir):
+    pdbIndex = run_initial_refinement.build_reference_pdb_index(pdbDir)
+    matched = 0
+    for sample_candidates in candidates.values():
+        best, reason = run_initial_refinement.select_best_dataset(sample_candidates, None, pdbIndex)
+        if best:
+            pdb, diff, pdb_name = run_initial_refinement.find_pdb_input_file(pdbDir, best['mtz'], pdbIndex)
+            matched += pdb is not None
+    return matched
+
+
+def scan_all(sample_folders, pdbDir, jobs):
+    pdbIndex = run_initial_refinement.build_reference_pdb_index(pdbDir)
+    for result in run_initial_refinement.scan_samples(sample_folders, pdbDir, pdbIndex, None, False, jobs):
+        run_initial_refinement.mtzCache.merge_delta(result['mtz_cache'])
+
+
+def read_datasets(projectDir):
+    """ times main_window.read_datasets; only possible inside COOT, e.g. coot --no-graphics --script """
+    import batch_model_and_refine
+    import gtk
+    window = batch_model_and_refine.main_window()
+    window.crystal_progressbar = gtk.ProgressBar()
+    window.cb = gtk.combo_box_new_text()
+    window.projectDir = projectDir
+    window.project_data['settings']['project_directory'] = projectDir
+    window.read_datasets(None)
+    return len(window.project_data['datasets'])
+
+
+def benchmark_size(workDir, n_samples, jobs):
+    stages = {}
+    counts = {'samples': n_samples}
+    campaignDir = os.path.join(workDir, 'campaign_{0!s}'.format(n_samples))
+    if os.path.isdir(campaignDir):
+        processDir = os.path.join(campaignDir, 'process')
+        pdbDir = os.path.join(campaignDir, 'pdb')
+        projectDir = os.path.join(campaignDir, 'project')
+    else:
+        processDir, pdbDir, projectDir = timed(stages, 'generate', make_campaign, campaignDir, n_samples)
+    sample_folders = sorted(glob.glob(os.path.join(processDir, '*')))
+
+    candidates, counts['fs_calls'] = timed(stages, 'discovery', discover_all, sample_folders)
+    counts['candidates'] = sum(len(c) for c in candidates.values())
+
+    run_initial_refinement.mtzCache = run_initial_refinement.mtz_header_cache()
+    timed(stages, 'mtz_analysis_cold', analyse_all_mtz, candidates)
+    timed(stages, 'mtz_analysis_warm', analyse_all_mtz, candidates)
+    counts['matched'] = timed(stages, 'reference_matching', match_references, candidates, pdbDir)
+
+    run_initial_refinement.mtzCache = run_initial_refinement.mtz_header_cache()
+    timed(stages, 'full_scan_jobs_{0!s}'.format(jobs), scan_all, sample_folders, pdbDir, jobs)
+
+    try:
+        counts['datasets'] = timed(stages, 'read_datasets', read_datasets, projectDir)
+    except ImportError:
+        stages['read_datasets'] = None
+        print('INFO: skipping read_datasets; it can only be timed inside COOT')
+    return {'stages': stages, 'counts': counts}
+
+
+def compare_with_baseline(results, baselineFile, tolerance):
+    with open(baselineFile) as f:
+        baseline = json.load(f)
+    regressions = []
+    for size, result in results['results'].items():
+        if size not in baseline['results']:
+            continue
+        for stage, seconds in result['stages'].items():
+            before = baseline['results'][size]['stages'].get(stage)
+            if stage == 'generate' or not seconds or not before:
+                continue
+            ratio = seconds / before
+            print('{0:>8s} {1:<22s} {2:9.3f}s -> {3:9.3f}s  ({4:.2f}x)'.format(size, stage, before, seconds, ratio))
+            if ratio > 1.0 + tolerance:
+                regressions.append([size, stage, ratio])
+    for size, stage, ratio in regressions:
+        print('WARNING: {0!s} samples - {1!s} is {2:.2f}x slower than baseline'.format(size, stage, ratio))
+    return regressions
+
+
+def usage():
+    usage = (
+        '\n'
+        'usage:\n'
+        'ccp4-python benchmark/run_benchmark.py -o <results.json>\n'
+        '\n'
+        'additional command line options:\n'
+        '--output, -o\n'
+        '    json file for the results (default: benchmark_results.json)\n'
+        '--sizes, -n\n'
+        '    comma separated list of campaign sizes (default: 100,1000,10000)\n'
+        '--workdir, -w\n'
+        '    directory for the synthetic campaigns; existing campaigns are reused (default: temporary directory)\n'
+        '--jobs, -j\n'
+        '    worker processes for the full scan (default: 1)\n'
+        '--baseline, -b\n'
+        '    results of an earlier run; stages that got more than 20% slower are reported\n'
+    )
+    print(usage)
+
+
+def main(argv):
+    outputFile = 'benchmark_results.json'
+    sizes = [100, 1000, 10000]
+    workDir = None
+    jobs = 1
+    baselineFile = None
+
+    try:
+        opts, args = getopt.getopt(argv, "o:n:w:j:b:h", ["output=", "sizes=", "workdir=", "jobs=", "baseline="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-o", "--output"):
+            outputFile = arg
+        elif opt in ("-n", "--sizes"):
+            sizes = [int(n) for n in arg.split(',')]
+        elif opt in ("-w", "--workdir"):
+            workDir = arg
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt in ("-b", "--baseline"):
+            baselineFile = arg
+
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix='bmr_benchmark_')
+    results = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'workdir': workDir,
+        'results': {}
+    }
+    for n_samples in sizes:
+        print('>>> benchmarking {0!s} samples'.format(n_samples))
+        results['results'][str(n_samples)] = benchmark_size(workDir, n_samples, jobs)
+        print(json.dumps(results['results'][str(n_samples)], indent=1))
+        with open(outputFile, 'w') as f:
+            json.dump(results, f, indent=1)
+    print('INFO: results written to {0!s}'.format(outputFile))
+    if baselineFile:
+        compare_with_baseline(results, baselineFile, 0.2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+# Copyright (c) 2022, Tobias Krojer, MAX IV Laboratory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" directory creation, symlinking and script writing for the command line scripts
+
+    all paths are absolute and nothing changes the working directory or starts a shell, so that
+    samples can be staged from several threads at the same time
+"""
+
+import os
+import threading
+
+
+def write_atomic(path, content, mode=None):
+    """ writes content to a temporary file next to path and renames it, so that readers never see
+        a partially written file
+    """
+    tmp = '{0!s}.{1!s}.{2!s}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    os.replace(tmp, path)
+
+
+class file_stager(object):
+    """ stages files with absolute paths; with dry_run=True every action is only printed
+        counts of created directories, links and files are kept for a summary at the end of a run
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+        self.counts = {'directories': 0, 'links': 0, 'files': 0}
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def make_directory(self, path):
+        """ creates path and all missing parent directories; returns False if it already existed """
+        if os.path.isdir(path):
+            return False
+        if self.dry_run:
+            print('dry-run: mkdir -p {0!s}'.format(path))
+        else:
+            try:
+                os.makedirs(path)
+            except OSError:
+                # another thread may have created it in the meantime
+                if not os.path.isdir(path):
+                    raise
+        self.count('directories')
+        return True
+
+    def link(self, source, link_name, overwrite=False):
+        """ links link_name to source; an existing link is only replaced if overwrite is True,
+            existing regular files are never touched; returns False if nothing was done
+        """
+        if os.path.islink(link_name):
+            if not overwrite:
+                return False
+            if self.dry_run:
+                print('dry-run: rm {0!s}'.format(link_name))
+            else:
+                os.remove(link_name)
+        elif os.path.exists(link_name):
+            return False
+        if self.dry_run:
+            print('dry-run: ln -s {0!s} {1!s}'.format(source, link_name))
+        else:
+            os.symlink(source, link_name)
+        self.count('links')
+        return True
+
+    def unlink(self, link_name):
+        """ removes link_name if it is a link; regular files are never touched; returns False if nothing was done """
+        if not os.path.islink(link_name):
+            return False
+        if self.dry_run:
+            print('dry-run: rm {0!s}'.format(link_name))
+        else:
+            os.remove(link_name)
+        return True
+
+    def write_file(self, path, content, mode=None):
+        """ writes content atomically to path """
+        if self.dry_run:
+            print('dry-run: write {0!s} ({1!s} bytes)'.format(path, len(content)))
+        else:
+            write_atomic(path, content, mode)
+        self.count('files')
+
+    def summary(self):
+        return '{0!s}{1!s} directories, {2!s} links and {3!s} files staged'.format(
+            'dry-run: ' if self.dry_run else '', self.counts['directories'], self.counts['links'],
+            self.counts['files'])
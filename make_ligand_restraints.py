@@ -1,21 +1,37 @@
+import getopt
+import sys
 import os
+import re
 import csv
+import json
+import hashlib
+import itertools
+import signal
+import subprocess
+import threading
+import time
+import concurrent.futures
+
+from file_staging import file_stager
+
+try:
+    from rdkit import Chem
+except ImportError:
+    Chem = None
+
+stager = file_stager()
 
 
 def make_sample_directory(projectDir, sampleID):
-    os.chdir(projectDir)
-    if not os.path.isdir(sampleID):
+    if stager.make_directory(os.path.join(projectDir, sampleID)):
         print('{0!s}: making sample directory'.format(sampleID))
-        os.mkdir(sampleID)
     else:
         print('{0!s}: sample directory exists'.format(sampleID))
 
 
 def make_subdirectory(projectDir, sampleID, subdirectory):
-    os.chdir(os.path.join(projectDir, sampleID))
-    if not os.path.isdir(subdirectory):
+    if stager.make_directory(os.path.join(projectDir, sampleID, subdirectory)):
         print('{0!s}: making subirectory for ligand files with name {1!s}'.format(sampleID, subdirectory))
-        os.mkdir(subdirectory)
     else:
         print('{0!s}: subirectory for ligand files with name {1!s} exists'.format(sampleID, subdirectory))
 
@@ -30,12 +46,12 @@ def modules_to_load(restraints_program):
     return module
 
 
-def maxiv_header(restraints_program):
+def maxiv_header(restraints_program, cpus=1):
     header = (
         '#!/bin/bash\n'
         '#SBATCH --time=10:00:00\n'
         '#SBATCH --job-name={0!s}\n'.format(restraints_program) +
-        '#SBATCH --cpus-per-task=1\n'
+        '#SBATCH --cpus-per-task={0!s}\n'.format(cpus)
     )
     return header
 
@@ -50,48 +66,364 @@ def restraints_program_cmd(restraints_program, ligandID, smiles):
     return cmd
 
 
-def prepare_script_for_maxiv(restraints_program, projectDir, sampleID, subdirectory, ligandID, smiles):
-    os.chdir(os.path.join(projectDir, sampleID, subdirectory))
-    cmd = maxiv_header()
-    cmd += maxiv_header(restraints_program)
-    cmd += 'cd {0!s}\n'.format(os.path.join(projectDir, sampleID, subdirectory))
-    cmd += restraints_program_cmd(restraints_program, ligandID, smiles)
-    f = open('{0!s}.sh'.format(restraints_program), 'w')
-    f.write(cmd)
-    f.close()
-
-
-def submit_maxiv_script(restraints_program, projectDir, sampleID, subdirectory):
-    os.chdir(os.path.join(projectDir, sampleID, subdirectory))
-    print('{0!s}: submitting {1!s} to cluster'.format(sampleID, restraints_program))
-    os.system('sbatch {0!s}.sh'.format(restraints_program))
-
-
-def run_program_on_maxiv_cluster(restraints_program, projectDir, sampleID, subdirectory, ligandID, smiles):
-    prepare_script_for_maxiv(restraints_program, projectDir, sampleID, subdirectory, ligandID, smiles)
-    submit_maxiv_script(restraints_program, projectDir, sampleID, subdirectory)
-
-
-def run_program_on_local_machine(restraints_program, projectDir, sampleID, subdirectory, ligandID, smiles):
-    cmd = restraints_program_cmd(restraints_program, ligandID, smiles)
-    os.chdir(os.path.join(projectDir, sampleID, subdirectory))
-    os.system(cmd)
+def version_cmd(restraints_program):
+    if restraints_program == 'acedrg':
+        cmd = ['acedrg', '-v']
+    elif restraints_program == 'grade':
+        cmd = ['grade', '-checkdeps']
+    elif restraints_program == 'elbow':
+        cmd = ['phenix.elbow', '--version']
+    return cmd
 
-def make_ligand_restraints(projectDir, ligandCsv, restraints_program, overwrite, subdirectory, maxiv):
-    dialect = csv.Sniffer().sniff(open(ligandCsv).readline(), [',', ';'])
-    csvFile = csv.reader(open(ligandCsv), dialect)
 
-    for row in csvFile:
-        sampleID = row[0].replace(' ', '')
-        ligandID = row[1].replace(' ', '')
-        smiles = row[2].replace(' ', '')
+def program_version(restraints_program, maxiv):
+    """ first line of the version output of the restraints program; on the MAX IV cluster the program is
+        only available inside the job, so the module that is loaded there stands in for the version
+    """
+    if maxiv:
+        return modules_to_load(restraints_program)
+    try:
+        out = subprocess.check_output(version_cmd(restraints_program), stderr=subprocess.STDOUT,
+                                      universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    lines = [l.strip() for l in out.splitlines() if l.strip()]
+    return lines[0] if lines else 'unknown'
+
+
+def canonical_smiles(smiles):
+    """ RDKit canonical SMILES if RDKit is installed and can parse smiles, otherwise smiles itself """
+    if Chem is not None:
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is not None:
+            return Chem.MolToSmiles(mol)
+    return smiles
+
+
+class restraint_cache(object):
+    """ restraints of every unique ligand are computed once in <cacheDir>/<program>/<key>, where key is a hash
+        of canonical SMILES, program and program version; samples get symlinks to the cached files
+    """
+
+    prefix = 'restraints'
+    extensions = ['.cif', '.pdb']
+
+    def __init__(self, cacheDir, restraints_program, version, overwrite=False):
+        self.cacheDir = cacheDir
+        self.restraints_program = restraints_program
+        self.version = version
+        self.overwrite = overwrite
+        self.scheduled = set()
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, smiles):
+        canonical = canonical_smiles(smiles)
+        key = hashlib.sha1('{0!s}|{1!s}|{2!s}'.format(canonical, self.restraints_program, self.version)
+                           .encode('utf-8')).hexdigest()
+        return canonical, os.path.join(self.cacheDir, self.restraints_program, key)
+
+    def lookup(self, smiles):
+        """ returns (entryDir, hit); on a miss the entry directory is created and the restraints still need
+            to be computed there
+        """
+        canonical, entryDir = self.entry(smiles)
+        done = os.path.isfile(os.path.join(entryDir, self.prefix + self.extensions[0]))
+        if entryDir in self.scheduled or (done and not self.overwrite):
+            self.hits += 1
+            return entryDir, True
+        exitFile = os.path.join(entryDir, '{0!s}.exit'.format(self.restraints_program))
+        if os.path.isfile(exitFile):
+            print('WARNING: previous {0!s} job for {1!s} exited with {2!s}; trying again'.format(
+                self.restraints_program, smiles, open(exitFile).read().strip()))
+        self.misses += 1
+        self.scheduled.add(entryDir)
+        stager.make_directory(entryDir)
+        stager.write_file(os.path.join(entryDir, 'entry.json'), json.dumps({
+            'smiles': smiles, 'canonical_smiles': canonical, 'restraints_program': self.restraints_program,
+            'version': self.version}, indent=1))
+        return entryDir, False
+
+    def link(self, entryDir, ligandDir, ligandID):
+        # links may point to files that a cluster job is still computing
+        for ext in self.extensions:
+            source = os.path.join(entryDir, self.prefix + ext)
+            link_name = os.path.join(ligandDir, ligandID + ext)
+            if not (os.path.islink(link_name) and os.readlink(link_name) == source):
+                stager.link(source, link_name, overwrite=True)
+
+    def summary(self):
+        return 'restraint cache: {0!s} hits, {1!s} misses ({2!s} ligands -> {3!s} restraint jobs)'.format(
+            self.hits, self.misses, self.hits + self.misses, self.misses)
+
+
+def prepare_script_for_maxiv(restraints_program, workDir, ligandID, smiles):
+    cmd = maxiv_header(restraints_program)
+    cmd += modules_to_load(restraints_program) + '\n'
+    cmd += 'cd {0!s}\n'.format(workDir)
+    cmd += restraints_program_cmd(restraints_program, ligandID, smiles) + '\n'
+    stager.write_file(os.path.join(workDir, '{0!s}.sh'.format(restraints_program)), cmd)
+
+
+def submit_maxiv_script(restraints_program, workDir, label):
+    print('{0!s}: submitting {1!s} to cluster'.format(label, restraints_program))
+    if stager.dry_run:
+        print('dry-run: sbatch {0!s}.sh'.format(restraints_program))
+        return
+    try:
+        subprocess.call(['sbatch', '{0!s}.sh'.format(restraints_program)], cwd=workDir)
+    except OSError as e:
+        print('ERROR: cannot run sbatch: {0!s}'.format(e))
+
+
+class restraint_packer(object):
+    """ packs the restraint jobs for the MAX IV cluster: every ligand becomes one line in a task manifest and
+        every job (or array task) runs pack lines of the manifest with an in-job pool of workers programs
+        at the same time; each ligand writes its exit code to <program>.exit in its cache entry and failed
+        ligands are additionally appended to <manifest>.failed
+    """
+
+    def __init__(self, restraints_program, cacheDir, pack, array=False, workers=4):
+        self.restraints_program = restraints_program
+        self.jobDir = os.path.join(cacheDir, 'jobs')
+        self.pack = pack
+        self.array = array
+        self.workers = workers
+        self.tasks = []
+
+    def add(self, workDir, ligandID, smiles):
+        cmd = restraints_program_cmd(self.restraints_program, ligandID, smiles)
+        self.tasks.append(
+            'cd {0!s} && {1!s} > {2!s}.log 2>&1; code=$?; echo $code > {2!s}.exit; '
+            '[ $code -eq 0 ] || echo "{0!s} $code" >> "$FAILED"'.format(workDir, cmd, self.restraints_program))
+
+    def script(self, manifest):
+        cmd = maxiv_header(self.restraints_program, self.workers)
+        cmd += modules_to_load(self.restraints_program) + '\n'
+        cmd += (
+            '# task number: array index or first argument of the script\n'
+            'task=${{SLURM_ARRAY_TASK_ID:-$1}}\n'
+            'export FAILED={0!s}.failed\n'.format(manifest) +
+            'sed -n "$((task * {0!s} + 1)),$(((task + 1) * {0!s}))p" {1!s} | '.format(self.pack, manifest) +
+            'xargs -d "\\n" -n 1 -P {0!s} bash -c\n'.format(self.workers)
+        )
+        return cmd
+
+    def submit(self, args, label):
+        if stager.dry_run:
+            print('dry-run: sbatch {0!s}'.format(' '.join(args)))
+            return None
+        try:
+            out = subprocess.run(['sbatch'] + args, cwd=self.jobDir, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True).stdout
+        except OSError as e:
+            print('ERROR: cannot run sbatch: {0!s}'.format(e))
+            return None
+        match = re.search(r'Submitted batch job (\d+)', out)
+        if not match:
+            print('ERROR: submission of {0!s} failed: {1!s}'.format(label, out.strip()))
+            return None
+        return match.group(1)
+
+    def finish(self):
+        if not self.tasks:
+            return
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        manifest = os.path.join(self.jobDir, '{0!s}_{1!s}.tasks'.format(self.restraints_program, stamp))
+        script = os.path.join(self.jobDir, '{0!s}_{1!s}.sh'.format(self.restraints_program, stamp))
+        stager.make_directory(self.jobDir)
+        stager.write_file(manifest, '\n'.join(self.tasks) + '\n')
+        stager.write_file(script, self.script(manifest))
+        n_jobs = (len(self.tasks) + self.pack - 1) // self.pack
+        if self.array:
+            jobIDs = [self.submit(['--array=0-{0!s}'.format(n_jobs - 1), script], script)]
+        else:
+            jobIDs = [self.submit([script, str(n)], '{0!s} task {1!s}'.format(script, n)) for n in range(n_jobs)]
+        print('INFO: {0!s} ligands packed into {1!s} {2!s} of up to {3!s} ligands; job ID(s): {4!s}'.format(
+            len(self.tasks), n_jobs, 'array tasks' if self.array else 'jobs', self.pack,
+            ' '.join(j for j in jobIDs if j) or '-'))
+        print('INFO: task manifest: {0!s}; failed ligands are listed in {0!s}.failed'.format(manifest))
+        self.tasks = []
+
+
+def run_program_on_maxiv_cluster(restraints_program, workDir, label, ligandID, smiles):
+    prepare_script_for_maxiv(restraints_program, workDir, ligandID, smiles)
+    submit_maxiv_script(restraints_program, workDir, label)
+
+
+class local_runner(object):
+    """ runs restraint jobs on the local machine with at most N programs at the same time
+        every job runs in its own directory, writes stdout and stderr to <program>.log there and is killed
+        if it takes longer than timeout seconds
+    """
+
+    def __init__(self, jobs=1, timeout=None):
+        self.jobs = jobs
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.counts = {'succeeded': 0, 'failed': 0, 'timed out': 0}
+        self.start = time.time()
+
+    def run(self, restraints_program, workDir, label, cmd, expected):
+        with open(os.path.join(workDir, '{0!s}.log'.format(restraints_program)), 'w') as log:
+            # own session, so that a timeout kills the program and not only the shell that started it
+            process = subprocess.Popen(cmd, shell=True, cwd=workDir, stdout=log, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+            try:
+                exit_code = process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                exit_code = None
+        if exit_code is None:
+            result = 'timed out'
+            print('ERROR: {0!s} - {1!s} timed out after {2!s}s'.format(label, restraints_program, self.timeout))
+        elif exit_code == 0 and os.path.isfile(os.path.join(workDir, expected)):
+            result = 'succeeded'
+        else:
+            result = 'failed'
+            print('ERROR: {0!s} - {1!s} failed with exit code {2!s}; see {3!s}'.format(
+                label, restraints_program, exit_code, os.path.join(workDir, '{0!s}.log'.format(restraints_program))))
+        with self.lock:
+            self.counts[result] += 1
+        return result
+
+    def submit(self, restraints_program, workDir, label, ligandID, smiles, compound=None):
+        # compound is the ID that is reported if the job does not succeed (default: label)
+        cmd = restraints_program_cmd(restraints_program, ligandID, smiles)
+        if stager.dry_run:
+            print('dry-run: {0!s}'.format(cmd))
+            return
+        print('{0!s}: running {1!s} on local machine'.format(label, restraints_program))
+        future = self.executor.submit(self.run, restraints_program, workDir, label, cmd, ligandID + '.cif')
+        self.futures[future] = (label, restraints_program, compound or label)
+
+    def finish(self):
+        """ waits for all jobs; returns the sorted compound IDs of the jobs that did not succeed """
+        failed = set()
+        for future in concurrent.futures.as_completed(self.futures):
+            label, restraints_program, compound = self.futures[future]
+            try:
+                if future.result() != 'succeeded':
+                    failed.add(compound)
+            except Exception as e:
+                # e.g. the log file cannot be written or the shell cannot be started
+                print('ERROR: {0!s} - {1!s} could not be run: {2!s}'.format(label, restraints_program, e))
+                with self.lock:
+                    self.counts['failed'] += 1
+                failed.add(compound)
+        self.executor.shutdown(wait=True)
+        self.futures = {}
+        seconds = time.time() - self.start
+        total = sum(self.counts.values())
+        if total:
+            print('INFO: {0!s} restraint jobs succeeded, {1!s} failed, {2!s} timed out in {3:.1f}s '
+                  '({4:.1f} ligands/min with {5!s} jobs)'.format(self.counts['succeeded'], self.counts['failed'],
+                                                                  self.counts['timed out'], seconds,
+                                                                  60.0 * total / max(seconds, 1e-6), self.jobs))
+        return sorted(failed)
+
+
+class csv_report(object):
+    """ counts rows, errors and warnings of the ligand csv file while it is read; messages are printed
+        immediately, so memory does not grow with the number of rows
+    """
+
+    def __init__(self, ligandCsv):
+        self.ligandCsv = ligandCsv
+        self.rows = 0
+        self.ligands = 0
+        self.errors = 0
+        self.warnings = 0
+
+    def error(self, message):
+        print('ERROR: {0!s}'.format(message))
+        self.errors += 1
+
+    def warning(self, message):
+        print('WARNING: {0!s}'.format(message))
+        self.warnings += 1
+
+    def summary(self):
+        print('INFO: found {0!s} lines in {1!s}: {2!s} ligands, {3!s} errors, {4!s} warnings'.format(
+            self.rows, self.ligandCsv, self.ligands, self.errors, self.warnings))
+
+
+def read_ligand_csv(ligandCsv, report):
+    """ yields validated (sampleID, ligandID, smiles) records from the ligand csv file in a single pass
+        the delimiter is sniffed from the first line; space characters are removed from all fields and rows
+        with missing values are reported and skipped
+    """
+    try:
+        f = open(ligandCsv)
+    except (IOError, OSError) as e:
+        report.error('cannot open csv file: {0!s}'.format(e))
+        return
+    with f:
+        try:
+            first = f.readline()
+        except UnicodeDecodeError:
+            report.error('that does not look like a csv file')
+            return
+        try:
+            dialect = csv.Sniffer().sniff(first, [',', ';'])
+        except csv.Error:
+            dialect = csv.excel
+        try:
+            for row in csv.reader(itertools.chain([first], f), dialect):
+                report.rows += 1
+                if not row or not ''.join(row).strip():
+                    continue
+                fields = [field.strip() for field in row[:3]]
+                if len(fields) < 3 or not all(fields):
+                    report.error('missing value in line {0!s}: {1!s}'.format(report.rows, row))
+                    continue
+                for name, field in zip(['sampleID', 'ligandID', 'smiles'], fields):
+                    if ' ' in field:
+                        report.warning('there is a space character in {0!s} field -> {1!s}; '
+                                       'all space characters will be removed!'.format(name, field))
+                report.ligands += 1
+                yield tuple(field.replace(' ', '') for field in fields)
+        except UnicodeDecodeError:
+            report.error('that does not look like a csv file (line {0!s})'.format(report.rows + 1))
+
+
+def make_ligand_restraints(projectDir, ligandCsv, restraints_program, overwrite, subdirectory, maxiv, cacheDir=None,
+                           jobs=1, timeout=None, pack=None, array=False, workers=4):
+    """ returns the number of csv lines that were skipped and the IDs of the compounds whose restraint jobs
+        did not succeed
+    """
+    report = csv_report(ligandCsv)
+    cacheDir = cacheDir or os.path.join(os.path.abspath(projectDir), 'restraints_cache')
+    cache = restraint_cache(cacheDir, restraints_program, program_version(restraints_program, maxiv), overwrite)
+    runner = local_runner(jobs, timeout)
+    packer = None
+    if maxiv and (pack or array):
+        packer = restraint_packer(restraints_program, cacheDir, pack or 1, array, workers)
+
+    for sampleID, ligandID, smiles in read_ligand_csv(ligandCsv, report):
         make_sample_directory(projectDir, sampleID)
         if subdirectory:
             make_subdirectory(projectDir, sampleID, subdirectory)
-        if maxiv:
-            run_program_on_maxiv_cluster(restraints_program, projectDir, sampleID, subdirectory, ligandID, smiles)
+        entryDir, hit = cache.lookup(smiles)
+        if hit:
+            print('{0!s}: restraints for {1!s} found in cache'.format(sampleID, ligandID))
+        elif packer:
+            packer.add(entryDir, restraint_cache.prefix, smiles)
+        elif maxiv:
+            run_program_on_maxiv_cluster(restraints_program, entryDir, sampleID, restraint_cache.prefix, smiles)
         else:
-            run_program_on_local_machine(restraints_program, projectDir, sampleID, subdirectory, ligandID, smiles)
+            runner.submit(restraints_program, entryDir, sampleID, restraint_cache.prefix, smiles, ligandID)
+        cache.link(entryDir, os.path.join(projectDir, sampleID, subdirectory), ligandID)
+    failed = runner.finish()
+    if packer:
+        packer.finish()
+    report.summary()
+    print(cache.summary())
+    print(stager.summary())
+    return report.errors, failed
 
 
 def usage():
@@ -113,55 +445,35 @@ def usage():
         '    flag to running script on MAXIV offline cluster"\n'
         '--overwrite, -o\n'
         '    flag to overwrite existing files\n'
+        '--dry-run\n'
+        '    only print which folders and scripts would be created and which programs would be run\n'
+        '--cache-dir\n'
+        '    directory for restraints of unique ligands (default: <project_dir>/restraints_cache)\n'
+        '--jobs, -j\n'
+        '    number of restraint programs running at the same time on the local machine (default: 1)\n'
+        '--timeout\n'
+        '    kill local restraint jobs after this many seconds (default: 3600)\n'
+        '--pack\n'
+        '    with --maxiv: run this many ligands per cluster job instead of one job per ligand, e.g. --pack 50\n'
+        '--array\n'
+        '    with --maxiv: submit all packed jobs as one Slurm job array\n'
+        '--job-workers\n'
+        '    number of ligands running at the same time inside a packed job (default: 4)\n'
     )
     print(usage)
 
 def check_csv(ligandCsv):
+    # the contents are validated while the file is read by read_ligand_csv()
     print('-> checking csv file: {0!s}'.format(ligandCsv))
     passed = True
-    try:
-        dialect = csv.Sniffer().sniff(open(ligandCsv).readline(), [',', ';'])
-    except FileNotFoundError:
+    if ligandCsv is None or not os.path.isfile(ligandCsv):
         print('ERROR: csv file does not exists')
         passed = False
-    except UnicodeDecodeError:
-        print('ERROR: that does not look like a csv file')
-        passed = False
-    if passed:
+    else:
         print('OK: csv file exists')
     return passed
 
 
-def check_csv_content(ligandCsv, passed):
-    print('-> checking contents of csv file: {0!s}'.format(ligandCsv))
-    passed = True
-    dialect = csv.Sniffer().sniff(open(ligandCsv).readline(), [',', ';'])
-    csvFile = csv.reader(open(ligandCsv), dialect)
-    line_number = -1
-    for line_number, row in enumerate(csvFile):
-        warning = False
-        if len(row) < 3:
-            print('ERROR: missing value in row: {0!s}'.format(row))
-            passed = False
-        else:
-            sampleID = row[0]
-            ligandID = row[1]
-            smiles = row[2]
-            if ' ' in sampleID:
-                print('WARNING: there is a space character in sampleID field -> {0!s}'.format(sampleID))
-                warning = True
-            if ' ' in ligandID:
-                print('WARNING: there is a space character in ligandID field -> {0!s}'.format(ligandID))
-                warning = True
-            if ' ' in smiles:
-                print('WARNING: there is a space character in smiles field -> {0!s}'.format(smiles))
-                warning = True
-            if warning:
-                print('WARNING: all space characters will be removed!')
-    print('INFO: found {0!s} lines in {1!s}'.format(line_number+1, ligandCsv))
-    return passed
-
-
 def check_if_project_directory_exists(projectDir, passed):
     print('-> checking project directory: {0!s}'.format(projectDir))
     passed = True
@@ -187,9 +499,7 @@ def check_restraints_program_option(restraints_program, passed):
 def run_checks(projectDir, ligandCsv, restraints_program):
     print('>>> checking input file and command line options')
     passed = check_csv(ligandCsv)
-    if passed:
-        check_csv_content(ligandCsv, passed)
-    passed = check_if_project_directory_exists(projectDir, passed)
+    passed = check_if_project_directory_exists(projectDir, passed) and passed
     passed = check_restraints_program_option(restraints_program, passed)
     return passed
 
@@ -201,10 +511,19 @@ def main(argv):
     restraints_program = None
     maxiv = False
     overwrite = False
+    dry_run = False
+    cacheDir = None
+    jobs = 1
+    timeout = 3600
+    pack = None
+    array = False
+    workers = 4
 
     try:
-        opts, args = getopt.getopt(argv,"p:l:r:s:ho",["project-directory=", "ligand-csv=", "subdirectory=",
-                                                         "restraints-program=", "overwrite", "maxiv"])
+        opts, args = getopt.getopt(argv,"p:l:r:s:j:hom",["project-directory=", "ligand-csv=", "subdirectory=",
+                                                         "restraints-program=", "overwrite", "maxiv", "dry-run",
+                                                         "cache-dir=", "jobs=", "timeout=", "pack=", "array",
+                                                         "job-workers="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -222,14 +541,37 @@ def main(argv):
         elif opt in ("-r", "--restraints-program"):
             restraints_program = arg
         elif opt in ("-m", "--maxiv"):
+            maxiv = True
+        elif opt in ("-o", "--overwrite"):
             overwrite = True
-        elif opt in ("-p", "--overwrite"):
-            overwrite = True
+        elif opt == "--dry-run":
+            dry_run = True
+        elif opt == "--cache-dir":
+            cacheDir = os.path.abspath(arg)
+        elif opt in ("-j", "--jobs"):
+            jobs = max(1, int(arg))
+        elif opt == "--timeout":
+            timeout = float(arg)
+        elif opt == "--pack":
+            pack = max(1, int(arg))
+        elif opt == "--array":
+            array = True
+        elif opt == "--job-workers":
+            workers = max(1, int(arg))
+
+    global stager
+    stager = file_stager(dry_run)
 
     checks_passed = run_checks(projectDir, ligandCsv, restraints_program)
 
     if checks_passed:
-        make_ligand_restraints(projectDir, ligandCsv, restraints_program, overwrite, subdirectory, maxiv)
+        errors, failed = make_ligand_restraints(projectDir, ligandCsv, restraints_program, overwrite, subdirectory,
+                                                maxiv, cacheDir, jobs, timeout, pack, array, workers)
+        if errors:
+            print('some lines of the csv file were skipped, please check comments above')
+        if failed:
+            print('ERROR: {0!s} failed for {1!s} compound(s): {2!s}'.format(
+                restraints_program, len(failed), ', '.join(failed)))
     else:
         print('something is wrong, please check comments above and use -h option for more information')
 
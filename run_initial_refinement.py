@@ -22,26 +22,310 @@ import getopt
 import glob
 import sys
 import os
+import json
+import csv
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import re
+import subprocess
+import threading
+import cProfile
+import bisect
+import fnmatch
+import functools
+import concurrent.futures
 import gemmi
+import numpy as np
 from tabulate import tabulate
+from file_staging import file_stager, write_atomic
 
 
-def analyse_process_directory(sample_folder, pdbDir):
-    table = []
+class stage_profiler(object):
+    """ collects wall time, number of calls, bytes read and filesystem calls per stage
+        does nothing unless enabled with --profile; times of nested stages are inclusive
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.fs_calls = 0
+
+    def count_fs(self, n=1):
+        self.fs_calls += n
+
+    def bytes_read(self):
+        # rchar counts every byte read by the process, including from the page cache; Linux only
+        try:
+            with open('/proc/self/io') as f:
+                for line in f:
+                    if line.startswith('rchar:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def record(self, stage, seconds, bytes_read, fs_calls):
+        stats = self.stats.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'bytes_read': 0, 'fs_calls': 0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['bytes_read'] += bytes_read
+        stats['fs_calls'] += fs_calls
+
+    def take_delta(self):
+        delta = self.stats
+        self.stats = {}
+        return delta
+
+    def merge_delta(self, delta):
+        for stage, stats in delta.items():
+            total = self.stats.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'bytes_read': 0, 'fs_calls': 0})
+            for key in total:
+                total[key] += stats[key]
+
+    def summary(self):
+        header = ['stage', 'calls', 'wall time (s)', 'ms/call', 'MB read', 'fs calls']
+        table = []
+        for stage, stats in sorted(self.stats.items(), key=lambda x: -x[1]['seconds']):
+            table.append([stage, stats['calls'], round(stats['seconds'], 3),
+                          round(1000 * stats['seconds'] / stats['calls'], 3),
+                          round(stats['bytes_read'] / 1e6, 3), stats['fs_calls']])
+        print(tabulate(table, headers=header), file=messages)
+
+
+profiler = stage_profiler()
+
+
+def profiled(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            bytes_before = profiler.bytes_read()
+            fs_before = profiler.fs_calls
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(stage, time.perf_counter() - start, profiler.bytes_read() - bytes_before,
+                                profiler.fs_calls - fs_before)
+        return wrapper
+    return decorator
+
+
+class mtz_header_cache(object):
+    """ on-disk cache of MTZ header information (unit cell, space group, resolution) and of the statistics
+        read from processing log files; entries are keyed by the absolute path of the file and are only valid
+        as long as file size and modification time have not changed
+    """
+
+    def __init__(self, cacheFile=None):
+        self.cacheFile = cacheFile
+        self.entries = {}
+        self.updated = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        if self.cacheFile and os.path.isfile(self.cacheFile):
+            try:
+                with open(self.cacheFile) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('WARNING: cannot read MTZ header cache {0!s}; starting a new one'.format(self.cacheFile),
+                      file=messages)
+
+    def get(self, mtzfile, reader=None):
+        # reader parses files that are not MTZ files, e.g. parse_log_statistics
+        key = os.path.abspath(mtzfile)
+        stat = os.stat(mtzfile)
+        profiler.count_fs()
+        entry = self.entries.get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            self.hits += 1
+            return entry['header']
+        self.misses += 1
+        profiler.count_fs()
+        header = (reader or read_mtz_header)(mtzfile)
+        self.entries[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'header': header}
+        self.updated[key] = self.entries[key]
+        self.changed = True
+        return header
+
+    def take_delta(self):
+        # new entries and counters since the last call; used to hand results back from worker processes
+        delta = {'entries': self.updated, 'hits': self.hits, 'misses': self.misses}
+        self.updated = {}
+        self.hits = 0
+        self.misses = 0
+        return delta
+
+    def merge_delta(self, delta):
+        if delta['entries']:
+            self.entries.update(delta['entries'])
+            self.changed = True
+        self.hits += delta['hits']
+        self.misses += delta['misses']
+
+    def save(self):
+        if not self.cacheFile or not self.changed:
+            return
+        cacheDir = os.path.dirname(os.path.abspath(self.cacheFile))
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        write_atomic(self.cacheFile, json.dumps(self.entries))
+        self.changed = False
+
+
+class project_manifest(object):
+    """ records for every sample the selected MTZ file, the reference PDB, the refinement script and the
+        submitted job, so that later runs only need to process new or changed samples
+    """
+
+    def __init__(self, projectDir):
+        self.manifestFile = os.path.join(projectDir, 'initial_refinement_manifest.json')
+        self.samples = {}
+        if os.path.isfile(self.manifestFile):
+            try:
+                with open(self.manifestFile) as f:
+                    self.samples = json.load(f)['samples']
+            except (ValueError, KeyError):
+                print('WARNING: cannot read manifest {0!s}; all samples will be processed'.format(self.manifestFile))
+
+    def is_up_to_date(self, sample, sample_folder):
+        """ a sample is up-to-date if a job was submitted and neither the sample folder, nor any of the
+            pipeline folders found in it, nor the selected MTZ file have changed since; a new pipeline
+            run inside an existing subfolder changes the mtime of the folder it was written to
+        """
+        entry = self.samples.get(sample)
+        if not entry or not entry.get('job_id'):
+            return False
+        if entry.get('exit_code') not in (None, 0):
+            # failed local jobs are retried
+            return False
+        if 'folder_mtimes' not in entry:
+            # written before pipeline folders were recorded
+            return False
+        try:
+            if os.stat(sample_folder).st_mtime != entry['sample_folder_mtime']:
+                return False
+            if folder_mtimes(entry['folder_mtimes']) != entry['folder_mtimes']:
+                return False
+            return os.stat(entry['mtz']).st_mtime == entry['mtz_mtime']
+        except OSError:
+            return False
+
+    def same_mtz(self, sample, mtz):
+        entry = self.samples.get(sample)
+        try:
+            return bool(entry) and entry.get('mtz') == mtz and os.stat(mtz).st_mtime == entry.get('mtz_mtime')
+        except OSError:
+            return False
+
+    def record(self, sample, **fields):
+        self.samples.setdefault(sample, {}).update(fields)
+
+    def save(self):
+        if stager.dry_run:
+            return
+        write_atomic(self.manifestFile, json.dumps({'samples': self.samples}, indent=1, sort_keys=True))
+
+
+def folder_mtimes(folders):
+    mtimes = {}
+    for folder in folders:
+        try:
+            mtimes[folder] = os.stat(folder).st_mtime
+        except OSError:
+            mtimes[folder] = None
+    return mtimes
+
+
+def default_mtz_cache_file():
+    return os.path.join(os.path.expanduser('~'), '.batch_model_and_refine', 'mtz_header_cache.json')
+
+
+mtzCache = mtz_header_cache()
+stager = file_stager()
+# stream for informational messages; None is the current sys.stdout, main sets sys.stderr when analysis
+# records are streamed to stdout
+messages = None
+# set by init_scan_worker in the processes of the scan pool
+in_worker = False
+
+
+def analyse_process_directory(sample_folder, pdbDir, pdbIndex=None, candidates=None):
+    """ returns one record per (run, pipeline) with resolution, space group, reference match and file paths """
+    records = []
+    if candidates is None:
+        candidates, fsCalls = discover_sample(sample_folder)
+    for candidate in candidates:
+        mtz = mtz_info(candidate['mtz'])
+        pdb, diff, pdb_name = find_pdb_input_file(pdbDir, candidate['mtz'], pdbIndex)
+        records.append({
+            'sample': os.path.basename(sample_folder),
+            'run': candidate['run'],
+            'pipeline': candidate['pipeline'],
+            'resolution_high': round(float(mtz['resolution_high']), 2),
+            'space_group': mtz['space_group'],
+            'reference_pdb': pdb_name,
+            'delta_uc_volume': diff,
+            'mtz': candidate['mtz'],
+            'log': candidate['log'],
+            'cif': candidate['cif']
+        })
+    return records
+
+
+def print_analysis_table(records):
     header = ['run', 'process', 'resolution', 'spacegroup', 'reference_pdb', 'delta(UCvolume)']
-    pipelines = ['autoproc', 'staraniso', 'dials']
-    for runs in sorted(glob.glob(os.path.join(sample_folder, '*'))):
-        run = runs.split('/')[len(runs.split('/'))-1]
-        for process_pipeline in pipelines:
-            pipeline, mtz_extension, log_extension, cif_extension = get_pipeline_path(process_pipeline)
-            for mtzfile in sorted(glob.glob(os.path.join(runs, pipeline))):
-                mtz = mtz_info(mtzfile)
-                pdb, diff, pdb_name = find_pdb_input_file(pdbDir, mtzfile)
-                table.append([run, process_pipeline, round(float(mtz['resolution_high']), 2), mtz['space_group'], pdb_name, diff])
+    table = [[r['run'], r['pipeline'], r['resolution_high'], r['space_group'], r['reference_pdb'], r['delta_uc_volume']]
+             for r in records]
     print(tabulate(table, headers=header))
     print("\n")
 
 
+class analysis_writer(object):
+    """ streams analysis records as csv or jsonl; records are flushed as soon as a sample is analysed """
+
+    fields = ['sample', 'run', 'pipeline', 'resolution_high', 'space_group', 'reference_pdb', 'delta_uc_volume',
+              'mtz', 'log', 'cif']
+
+    def __init__(self, output_format, stream):
+        self.output_format = output_format
+        self.stream = stream
+        self.pipelines = []
+        self.resolutions = []
+        if self.output_format == 'csv':
+            self.writer = csv.DictWriter(self.stream, fieldnames=self.fields)
+            self.writer.writeheader()
+
+    def write(self, records):
+        for record in records:
+            if self.output_format == 'csv':
+                self.writer.writerow(record)
+            else:
+                self.stream.write(json.dumps(record) + '\n')
+            self.pipelines.append(record['pipeline'])
+            self.resolutions.append(record['resolution_high'])
+        self.stream.flush()
+
+    def summary(self):
+        """ per-pipeline counts and resolution percentiles """
+        header = ['pipeline', 'datasets', 'min', 'p25', 'median', 'p75', 'max']
+        table = []
+        if self.resolutions:
+            pipelines = np.array(self.pipelines)
+            resolutions = np.array(self.resolutions, dtype=float)
+            names, groups, counts = np.unique(pipelines, return_inverse=True, return_counts=True)
+            for n, name in enumerate(names):
+                percentiles = np.percentile(resolutions[groups == n], [0, 25, 50, 75, 100])
+                table.append([name, counts[n]] + [round(p, 2) for p in percentiles])
+        print(tabulate(table, headers=header), file=messages)
+
+
 def print_summary():
     print('\n')
     print('Number of samples: ')
@@ -50,9 +334,7 @@ def print_summary():
 
 def create_sample_folder_in_project_dir(projectDir, sample, analyseOnly):
     if not analyseOnly:
-        os.chdir(projectDir)
-        if not os.path.isdir(sample):
-            os.mkdir(sample)
+        stager.make_directory(os.path.join(projectDir, sample))
 
 def get_pipeline_path(process_pipeline):
 
@@ -86,56 +368,275 @@ def get_pipeline_path(process_pipeline):
         cif_extension = 'DataFiles/xia2.mmcif.bz2'
     return pipeline, mtz_extension, log_extension, cif_extension
 
-def find_autoproc_results(sample_folder, process_pipeline):
+def process_pipelines():
+    return ['autoproc', 'staraniso', 'dials']
+
+
+def pipeline_layouts():
+    """ splits the paths from get_pipeline_path into pattern components relative to the sample folder;
+        the first component is the run folder
+    """
+    layouts = []
+    for process_pipeline in process_pipelines():
+        pipeline, mtz_extension, log_extension, cif_extension = get_pipeline_path(process_pipeline)
+        base = pipeline.replace(os.sep, '/')[:-len(mtz_extension)].strip('/').split('/')
+        for kind, extension in [('mtz', mtz_extension), ('log', log_extension), ('cif', cif_extension)]:
+            layouts.append([process_pipeline, kind, len(base), ['*'] + base + extension.split('/')])
+    return layouts
+
+
+def layout_tree():
+    """ merges all pipeline layouts into a single tree of file name patterns, so that one walk
+        through the sample folder finds the files of every pipeline
+    """
+    tree = {'dirs': {}, 'files': {}}
+    for process_pipeline, kind, base_depth, components in pipeline_layouts():
+        node = tree
+        for pattern in components[:-1]:
+            node = node['dirs'].setdefault(pattern, {'dirs': {}, 'files': {}})
+        node['files'].setdefault(components[-1], []).append([process_pipeline, kind, base_depth])
+    return tree
+
+
+def walk_sample_folder(sample_folder, visited=None):
+    """ walks the sample folder once with os.scandir and only descends into directories matching a
+        pipeline layout; returns the matching files and the number of filesystem calls it needed
+        every directory that was listed is appended to visited if it is given
+    """
+    found = []
+    fsCalls = [0]
+    tree = layout_tree()
+
+    def is_type(entry, is_dir):
+        # d_type from the directory listing is free, only symlinks need an extra stat
+        if entry.is_symlink():
+            fsCalls[0] += 1
+        try:
+            return entry.is_dir() if is_dir else entry.is_file()
+        except OSError:
+            return False
+
+    def walk(directory, relpath, node):
+        fsCalls[0] += 1
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+        if visited is not None:
+            visited.append(directory)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            for pattern, targets in node['files'].items():
+                if fnmatch.fnmatchcase(entry.name, pattern) and is_type(entry, False):
+                    for process_pipeline, kind, base_depth in targets:
+                        found.append([process_pipeline, kind, base_depth, relpath + [entry.name]])
+            for pattern, child in node['dirs'].items():
+                if fnmatch.fnmatchcase(entry.name, pattern) and is_type(entry, True):
+                    walk(entry.path, relpath + [entry.name], child)
+
+    walk(sample_folder, [], tree)
+    return found, fsCalls[0]
+
+
+@profiled('discover_sample')
+def discover_sample(sample_folder, visited=None):
+    """ returns one candidate record (run, pipeline, mtz, log, cif) for every MTZ file in the sample folder
+        log and cif are None if the pipeline did not write them
+    """
+    found, fsCalls = walk_sample_folder(sample_folder, visited)
+    profiler.count_fs(fsCalls)
+    files = {}
+    for process_pipeline, kind, base_depth, relpath in found:
+        # run folder + pipeline base folder identify the results of one pipeline run
+        key = (process_pipeline, tuple(relpath[:base_depth + 1]))
+        files.setdefault(key, {})[kind] = os.path.join(sample_folder, *relpath)
+    candidates = []
+    for (process_pipeline, base), record in files.items():
+        if 'mtz' not in record:
+            continue
+        candidates.append({
+            'run': base[0],
+            'pipeline': process_pipeline,
+            'mtz': record['mtz'],
+            'log': record.get('log'),
+            'cif': record.get('cif')
+        })
+    order = process_pipelines()
+    candidates.sort(key=lambda c: (c['run'], order.index(c['pipeline']), c['mtz']))
+    return candidates, fsCalls
+
+
+def read_log_statistics(logfile):
+    """ overall completeness and mean I/sigma(I) from the aimless, STARANISO or xia2.multiplex/dials.scale
+        summary table; values that cannot be found are None
+        results are kept in the MTZ header cache, so that unchanged log files are only read once
+    """
+    if not logfile:
+        return None, None
+    try:
+        completeness, isigma = mtzCache.get(logfile, parse_log_statistics)
+    except OSError:
+        return None, None
+    return completeness, isigma
+
+
+def parse_log_statistics(logfile):
+    completeness = None
+    isigma = None
+    number = r'\s+(-?[0-9]+\.?[0-9]*)'
+    try:
+        with open(logfile, errors='replace') as f:
+            for line in f:
+                # the last summary table in the log file is the final one
+                match = re.match(r'\s*Completeness(?: \(%\))?' + number, line)
+                if match:
+                    completeness = float(match.group(1))
+                match = re.match(r'\s*(?:Mean\(\(I\)/sd\(I\)\)|Mean I/sigma\(I\)|I/sigma)' + number, line)
+                if match:
+                    isigma = float(match.group(1))
+    except OSError:
+        pass
+    return completeness, isigma
+
+
+def default_ranking_weights():
+    weights = {
+        'resolution':   1.0,
+        'cell':         1.0,
+        'completeness': 0.5,
+        'isigma':       0.5
+    }
+    return weights
+
+
+def ranking_min_spans():
+    # differences smaller than these are not scaled up to the full weight of a metric
+    spans = {
+        'resolution':   0.5,
+        'cell':         0.02,
+        'completeness': 10.0,
+        'isigma':       5.0
+    }
+    return spans
+
+
+def cell_deviation(unitcell, reference):
+    # mean relative deviation of the cell axes plus mean angular deviation (in units of 90 degrees)
+    cell = np.array(unitcell, dtype=float)
+    ref = np.array(reference, dtype=float)
+    return float(np.mean(np.abs(cell[:3] - ref[:3]) / ref[:3]) + np.mean(np.abs(cell[3:] - ref[3:])) / 90.0)
+
+
+def rank_candidates(candidates, pdbIndex=None, weights=None):
+    """ scores all candidate datasets of a sample in one vectorized pass
+        metrics: high resolution limit (lower is better), unit cell deviation from the matched reference
+        (lower is better), completeness and I/sigma(I) (higher is better); every metric is scaled to 0..1
+        over the candidates, but over at least the span from ranking_min_spans(), so that e.g. 0.01 A in
+        resolution only counts a little; a metric that is missing for a candidate (no isomorphous reference,
+        no log statistics) scores 0, i.e. as the worst value
+        returns the weighted per-metric scores and the metric array
+    """
+    metric_names = ['resolution', 'cell', 'completeness', 'isigma']
+    if weights is None:
+        weights = default_ranking_weights()
+    metrics = np.full((len(candidates), len(metric_names)), np.nan)
+    for i, candidate in enumerate(candidates):
+        mtz = mtz_info(candidate['mtz'])
+        metrics[i, 0] = float(mtz['resolution_high'])
+        reference, diff = closest_reference(pdbIndex or {}, mtz['point_group'], mtz['unitcell_volume'])
+        if reference and diff < 0.1:
+            metrics[i, 1] = cell_deviation(mtz['unitcell'], reference['unitcell'])
+        completeness, isigma = read_log_statistics(candidate['log'])
+        if completeness is not None:
+            metrics[i, 2] = completeness
+        if isigma is not None:
+            metrics[i, 3] = isigma
+    available = ~np.isnan(metrics)
+    filled = np.where(available, metrics, 0.0)
+    lo = np.where(available, metrics, np.inf).min(axis=0)
+    hi = np.where(available, metrics, -np.inf).max(axis=0)
+    min_span = np.array([ranking_min_spans()[name] for name in metric_names])
+    span = np.maximum(np.where(hi > lo, hi - lo, 0.0), min_span)
+    lower_is_better = np.array([True, True, False, False])
+    # the best value of a metric always scores 1
+    scaled = np.where(lower_is_better, 1.0 - (filled - lo) / span, 1.0 - (hi - filled) / span)
+    scaled = np.where(available, scaled, 0.0)
+    w = np.array([float(weights.get(name, 0.0)) for name in metric_names])
+    return scaled * w, metrics
+
+
+def selection_reason(candidates, contributions, metrics, best):
+    labels = [['resolution', '{0:.2f} A'], ['cell deviation', '{0:.3f}'], ['completeness', '{0:.1f}%'],
+              ['I/sigma', '{0:.1f}']]
+    scores = contributions.sum(axis=1)
+
+    def describe(i):
+        parts = []
+        for j, (label, fmt) in enumerate(labels):
+            value = 'n/a' if np.isnan(metrics[i, j]) else fmt.format(metrics[i, j])
+            parts.append('{0!s} {1!s} (+{2:.2f})'.format(label, value, contributions[i, j]))
+        return '{0!s}/{1!s} score {2:.2f}: {3!s}'.format(candidates[i]['run'], candidates[i]['pipeline'],
+                                                          scores[i], ', '.join(parts))
+    reason = describe(best)
+    if len(candidates) > 1:
+        runner_up = int(np.argsort(-scores, kind='stable')[1])
+        reason += '; runner-up ' + describe(runner_up)
+    return reason
+
+
+@profiled('select_best_dataset')
+def select_best_dataset(candidates, process_pipeline=None, pdbIndex=None, weights=None):
+    """ returns the best candidate of a sample across all pipelines (or only process_pipeline if given)
+        together with a description why it was selected
+    """
+    if process_pipeline and process_pipeline != 'all':
+        candidates = [c for c in candidates if c['pipeline'] == process_pipeline]
+    if not candidates:
+        return None, None
+    contributions, metrics = rank_candidates(candidates, pdbIndex, weights)
+    # argmax returns the first of equal scores, i.e. the order from discover_sample
+    best = int(np.argmax(contributions.sum(axis=1)))
+    return candidates[best], selection_reason(candidates, contributions, metrics, best)
+
+
+@profiled('find_autoproc_results')
+def find_autoproc_results(sample_folder, process_pipeline, candidates=None, pdbIndex=None, weights=None):
     bestmtz = None
     bestlog = None
     bestcif = None
-    pipeline, mtz_extension, log_extension, cif_extension = get_pipeline_path(process_pipeline)
-    try:
-        resoList = []
-#        print('mtzfile', os.path.join(sample_folder, '*', pipeline))
-        for mtzfile in glob.glob(os.path.join(sample_folder, '*', pipeline)):
-            if os.path.isfile(mtzfile.replace(mtz_extension, log_extension)):
-                logfile = mtzfile.replace(mtz_extension, log_extension)
-            if os.path.isfile(mtzfile.replace(mtz_extension, cif_extension)):
-                ciffile = mtzfile.replace(mtz_extension, cif_extension)
-            else:
-                logfile = None
-#            mtz = gemmi.read_mtz_file(mtzfile)
-            mtz = mtz_info(mtzfile)
-#            print('>>>>>>>>>', mtz['unitcell'])
-            resoList.append([mtzfile, float(mtz['resolution_high']), logfile, ciffile])
-        if resoList:
-            bestmtz = min(resoList, key=lambda x: x[1])[0]
-            bestlog = min(resoList, key=lambda x: x[1])[2]
-            bestcif = min(resoList, key=lambda x: x[1])[3]
-    except UnboundLocalError:
-        pass
+    if candidates is None:
+        candidates, fsCalls = discover_sample(sample_folder)
+    best, reason = select_best_dataset(candidates, process_pipeline, pdbIndex, weights)
+    if best:
+        bestmtz, bestlog, bestcif = best['mtz'], best['log'], best['cif']
     return bestmtz, bestlog, bestcif
 
 
-def link_files_to_project_folder(projectDir, sample, mtz, log, cif):
-    os.chdir(os.path.join(projectDir, sample))
-    if not os.path.isfile('process.mtz'):
-        os.system('ln -s {0!s} process.mtz'.format(mtz))
-    if not os.path.isfile('process.log'):
-        os.system('ln -s {0!s} process.log'.format(log))
-    if not os.path.isfile('process.cif'):
-        os.system('ln -s {0!s} process.cif'.format(cif))
+@profiled('link_files_to_project_folder')
+def link_files_to_project_folder(projectDir, sample, mtz, log, cif, overwrite=False):
+    sampleDir = os.path.join(projectDir, sample)
+    for source, link in [(mtz, 'process.mtz'), (log, 'process.log'), (cif, 'process.cif')]:
+        if source:
+            stager.link(source, os.path.join(sampleDir, link), overwrite)
+            profiler.count_fs(2)
+        elif overwrite:
+            # the link would still point to the files of the previously selected dataset
+            stager.unlink(os.path.join(sampleDir, link))
+            profiler.count_fs()
 
 
 def mtz_point_group_uc_volume(mtzfile):
-    mtz = gemmi.read_mtz_file(mtzfile)
-    unitcell = mtz.cell
-    unitcell_volume = unitcell.volume
-    sym = mtz.spacegroup
-    point_group = sym.point_group_hm()
-    return point_group, unitcell_volume
+    mtz = mtz_info(mtzfile)
+    return mtz['point_group'], mtz['unitcell_volume']
 
-def mtz_info(mtzfile):
+
+def read_mtz_header(mtzfile):
+    # with_data=False only reads the MTZ header; resolution comes from the RESO record
+    mtz = gemmi.read_mtz_file(mtzfile, with_data=False)
     mtzDict = {}
-    mtz = gemmi.read_mtz_file(mtzfile)
-    mtzDict['unitcell'] = mtz.cell
+    mtzDict['unitcell'] = mtz.cell.parameters
     mtzDict['unitcell_volume'] = mtz.cell.volume
     mtzDict['point_group'] = mtz.spacegroup.point_group_hm()
     mtzDict['resolution_high'] = mtz.resolution_high()
@@ -143,6 +644,11 @@ def mtz_info(mtzfile):
     return mtzDict
 
 
+@profiled('mtz_info')
+def mtz_info(mtzfile):
+    return mtzCache.get(mtzfile)
+
+
 def pdb_point_group_uc_volume(pdbfile):
     structure = gemmi.read_pdb(pdbfile)
     unitcell = structure.cell
@@ -153,68 +659,745 @@ def pdb_point_group_uc_volume(pdbfile):
     return point_group, unitcell_volume
 
 
-def find_pdb_input_file(pdbDir, mtz):
+def read_pdb_cryst1(pdbfile):
+    # only the CRYST1 record is needed; coordinates are never parsed
+    with open(pdbfile) as f:
+        for line in f:
+            if line.startswith('CRYST1'):
+                unitcell = [float(line[6:15]), float(line[15:24]), float(line[24:33]),
+                            float(line[33:40]), float(line[40:47]), float(line[47:54])]
+                space_group = line[55:66].strip()
+                return unitcell, space_group
+            if line.startswith(('ATOM', 'HETATM')):
+                break
+    return None, None
+
+
+@profiled('build_reference_pdb_index')
+def build_reference_pdb_index(pdbDir):
+    """ reads the CRYST1 record of every PDB file in pdbDir once
+        returns a dictionary with point group as key and a list of references sorted by unit cell volume
+    """
+    pdbIndex = {}
+    if not pdbDir:
+        return pdbIndex
+    for pdbfile in sorted(glob.glob(os.path.join(pdbDir, '*.pdb'))):
+        try:
+            unitcell, space_group = read_pdb_cryst1(pdbfile)
+        except ValueError:
+            unitcell = None
+        if unitcell is None:
+            print('WARNING: {0!s} does not have a valid CRYST1 record; skipping'.format(pdbfile), file=messages)
+            continue
+        sym = gemmi.find_spacegroup_by_name(space_group)
+        if sym is None:
+            print('WARNING: unknown space group "{0!s}" in {1!s}; skipping'.format(space_group, pdbfile), file=messages)
+            continue
+        reference = {
+            'pdb': pdbfile,
+            'pdb_name': os.path.basename(pdbfile),
+            'point_group': sym.point_group_hm(),
+            'unitcell': unitcell,
+            'unitcell_volume': gemmi.UnitCell(*unitcell).volume
+        }
+        pdbIndex.setdefault(reference['point_group'], []).append(reference)
+    for point_group in pdbIndex:
+        pdbIndex[point_group].sort(key=lambda x: (x['unitcell_volume'], x['pdb_name']))
+    print('INFO: indexed {0!s} reference PDB files in {1!s}'.format(
+        sum(len(v) for v in pdbIndex.values()), pdbDir), file=messages)
+    return pdbIndex
+
+
+def closest_reference(pdbIndex, point_group, unitcell_volume):
+    """ returns the reference with the same point group and the smallest relative unit cell volume
+        difference, together with the difference; ties are resolved by file name
+    """
+    references = pdbIndex.get(point_group, [])
+    if not references:
+        return None, None
+    volumes = [r['unitcell_volume'] for r in references]
+    i = bisect.bisect_left(volumes, unitcell_volume)
+    # relative difference is monotonic on either side, so only the two neighbours can be closest
+    candidates = references[max(i - 1, 0):i + 1]
+    best = min(candidates, key=lambda r: (abs(unitcell_volume - r['unitcell_volume']) / r['unitcell_volume'],
+                                          r['pdb_name']))
+    return best, abs(unitcell_volume - best['unitcell_volume']) / best['unitcell_volume']
+
+
+@profiled('find_pdb_input_file')
+def find_pdb_input_file(pdbDir, mtz, pdbIndex=None):
     pdb = None
     pdb_name = None
+    if pdbIndex is None:
+        pdbIndex = build_reference_pdb_index(pdbDir)
     mtz_point_group, mtz_unitcell_volume = mtz_point_group_uc_volume(mtz)
-    for pdbfile in glob.glob(os.path.join(pdbDir, '*.pdb')):
-        pdb_point_group, pdb_unitcell_volume = pdb_point_group_uc_volume(pdbfile)
-        diff = abs(mtz_unitcell_volume - pdb_unitcell_volume) / pdb_unitcell_volume
-        if mtz_point_group == pdb_point_group and diff < 0.1:
-            pdb = pdbfile
-            pdb_name = pdb.split('/')[len(pdb.split('/'))-1]
+    reference, diff = closest_reference(pdbIndex, mtz_point_group, mtz_unitcell_volume)
+    if reference and diff < 0.1:
+        pdb = reference['pdb']
+        pdb_name = reference['pdb_name']
     return pdb, diff, pdb_name
 
 
-def prepare_init_refine_script(projectDir, sample, pdb, refine_pipeline):
-    os.chdir(os.path.join(projectDir, sample))
-    cmd = (
+def slurm_header(job_name):
+    header = (
             '#!/bin/bash\n'
             '#SBATCH --time=10:00:00\n'
-            '#SBATCH --job-name={0!s}\n'.format(refine_pipeline) +
+            '#SBATCH --job-name={0!s}\n'.format(job_name) +
             '#SBATCH --cpus-per-task=1\n'
     )
+    return header
 
+
+def init_refine_command(projectDir, sample, pdb, refine_pipeline, modules=True):
+    cmd = ''
     if refine_pipeline == 'dimple':
+        if modules:
+            cmd += 'module load gopresto CCP4/7.1.016-SHELX-ARP-8.0-1-PReSTO\n'
         cmd += (
-                'module load gopresto CCP4/7.1.016-SHELX-ARP-8.0-1-PReSTO\n'
                 'cd {0!s}\n'.format(os.path.join(projectDir, sample)) +
                 'dimple process.mtz {0!s} dimple'.format(pdb)
         )
 
     elif refine_pipeline == 'pipedream':
+        if modules:
+            cmd += 'module load gopresto BUSTER\n'
         cmd += (
-        		'module load gopresto BUSTER\n'
-        		'cd {0!s}\n'.format(os.path.join(projectDir, sample)) +
-        		'pipedream -hklin process.mtz -xyzin {0!s} -d pipedream -nofreeref -nolmr'.format(pdb)
+                'cd {0!s}\n'.format(os.path.join(projectDir, sample)) +
+                'pipedream -hklin process.mtz -xyzin {0!s} -d pipedream -nofreeref -nolmr'.format(pdb)
         )
+    return cmd
+
 
-    f = open('{0!s}.sh'.format(refine_pipeline), 'w')
-    f.write(cmd)
-    f.close()
+@profiled('prepare_init_refine_script')
+def prepare_init_refine_script(projectDir, sample, pdb, refine_pipeline, backend=None):
+    if backend is None:
+        backend = slurm_backend()
+    cmd = backend.script(projectDir, sample, pdb, refine_pipeline)
+    stager.write_file(os.path.join(projectDir, sample, '{0!s}.sh'.format(refine_pipeline)), cmd)
+    profiler.count_fs(2)
 
+@profiled('submit_init_refine_script')
 def submit_init_refine_script(projectDir, sample, refine_pipeline):
-    os.chdir(os.path.join(projectDir, sample))
     print('submitting {0!s} job for {1!s}'.format(refine_pipeline, sample))
-    os.system('sbatch {0!s}.sh'.format(refine_pipeline))
+    job_id = None
+    try:
+        out = subprocess.run(['sbatch', '{0!s}.sh'.format(refine_pipeline)], cwd=os.path.join(projectDir, sample),
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    except OSError as e:
+        print('ERROR: cannot run sbatch: {0!s}'.format(e))
+        return job_id
+    print(out.strip())
+    match = re.search(r'Submitted batch job (\d+)', out)
+    if match:
+        job_id = match.group(1)
+    return job_id
+
+
+@profiled('submit_init_refine_array')
+def submit_init_refine_array(projectDir, samples, refine_pipeline, throttle=None):
+    """ writes a task list with one line per sample (sample directory and refinement script) and an array
+        script that runs the line matching SLURM_ARRAY_TASK_ID, then submits all samples with one sbatch call;
+        returns a dictionary with the array task ID of every sample
+    """
+    jobIDs = {}
+    if not samples:
+        return jobIDs
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    taskFile = os.path.join(projectDir, 'init_refine_tasks_{0!s}.txt'.format(stamp))
+    arrayScript = os.path.join(projectDir, 'init_refine_array_{0!s}.sh'.format(stamp))
+    stager.write_file(taskFile, ''.join('{0!s}\t{1!s}.sh\n'.format(os.path.join(projectDir, sample), refine_pipeline)
+                                        for sample in samples))
+    cmd = slurm_header(refine_pipeline)
+    cmd += (
+            'task=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {0!s})\n'.format(taskFile) +
+            'cd "$(echo "$task" | cut -f1)"\n'
+            'bash "$(echo "$task" | cut -f2)"\n'
+    )
+    stager.write_file(arrayScript, cmd)
+    array = '0-{0!s}'.format(len(samples) - 1)
+    if throttle:
+        array += '%{0!s}'.format(throttle)
+    print('submitting {0!s} {1!s} jobs as job array {2!s}'.format(len(samples), refine_pipeline, array))
+    if stager.dry_run:
+        print('dry-run: sbatch --array={0!s} {1!s}'.format(array, arrayScript))
+        return jobIDs
+    try:
+        out = subprocess.run(['sbatch', '--array={0!s}'.format(array), arrayScript], cwd=projectDir,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    except OSError as e:
+        print('ERROR: cannot run sbatch: {0!s}'.format(e))
+        return jobIDs
+    print(out.strip())
+    match = re.search(r'Submitted batch job (\d+)', out)
+    if match:
+        for n, sample in enumerate(samples):
+            jobIDs[sample] = '{0!s}_{1!s}'.format(match.group(1), n)
+    return jobIDs
+
+
+class slurm_backend(object):
+    """ runs the initial refinement on a Slurm cluster, either as one job per sample or as a single job array """
+
+    name = 'slurm'
+
+    def __init__(self, array=False, throttle=None):
+        self.array = array
+        self.throttle = throttle
+        self.samples = []
+
+    def script(self, projectDir, sample, pdb, refine_pipeline):
+        return slurm_header(refine_pipeline) + init_refine_command(projectDir, sample, pdb, refine_pipeline)
+
+    def submit(self, projectDir, sample, refine_pipeline):
+        if self.array:
+            self.samples.append(sample)
+            return None
+        return submit_init_refine_script(projectDir, sample, refine_pipeline)
+
+    def finish(self, projectDir, refine_pipeline, wait=True):
+        """ returns a dictionary with manifest fields for every sample that was only submitted now """
+        records = {}
+        if self.array and self.samples:
+            for sample, job_id in submit_init_refine_array(projectDir, self.samples, refine_pipeline,
+                                                           self.throttle).items():
+                records[sample] = {'job_id': job_id}
+            self.samples = []
+        return records
+
+
+class local_backend(object):
+    """ runs the initial refinement on the local machine with at most N jobs at the same time
+        stdout, stderr and exit code of every job are written to <pipeline>.out, <pipeline>.err and
+        <pipeline>.exit in the sample folder
+    """
+
+    name = 'local'
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.counts = {'queued': 0, 'running': 0, 'completed': 0, 'failed': 0}
+
+    def script(self, projectDir, sample, pdb, refine_pipeline):
+        return '#!/bin/bash\n' + init_refine_command(projectDir, sample, pdb, refine_pipeline, modules=False) + '\n'
+
+    def run(self, sampleDir, refine_pipeline):
+        with self.lock:
+            self.counts['queued'] -= 1
+            self.counts['running'] += 1
+        with open(os.path.join(sampleDir, '{0!s}.out'.format(refine_pipeline)), 'w') as out, \
+                open(os.path.join(sampleDir, '{0!s}.err'.format(refine_pipeline)), 'w') as err:
+            try:
+                exit_code = subprocess.call(['bash', '{0!s}.sh'.format(refine_pipeline)], cwd=sampleDir,
+                                            stdout=out, stderr=err)
+            except OSError as e:
+                err.write(str(e))
+                exit_code = 127
+        with open(os.path.join(sampleDir, '{0!s}.exit'.format(refine_pipeline)), 'w') as f:
+            f.write('{0!s}\n'.format(exit_code))
+        with self.lock:
+            self.counts['running'] -= 1
+            self.counts['completed' if exit_code == 0 else 'failed'] += 1
+        print('INFO: {0!s} job for {1!s} finished with exit code {2!s} - {3!s}'.format(
+            refine_pipeline, os.path.basename(sampleDir), exit_code, self.summary()), file=messages)
+        return exit_code
+
+    def submit(self, projectDir, sample, refine_pipeline):
+        with self.lock:
+            self.counts['queued'] += 1
+        self.futures[sample] = self.executor.submit(self.run, os.path.join(projectDir, sample), refine_pipeline)
+        print('queueing {0!s} job for {1!s} on local machine - {2!s}'.format(refine_pipeline, sample, self.summary()))
+        return 'local'
+
+    def summary(self):
+        with self.lock:
+            return 'completed: {0!s}  failed: {1!s}  running: {2!s}  queued: {3!s}'.format(
+                self.counts['completed'], self.counts['failed'], self.counts['running'], self.counts['queued'])
+
+    def finish(self, projectDir, refine_pipeline, interval=10, wait=True):
+        """ returns the exit codes of all finished jobs that were not returned before
+            with wait=True it first waits for all jobs and prints a progress summary every interval seconds
+        """
+        if wait:
+            pending = set(self.futures.values())
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=interval)
+                print('INFO: {0!s}'.format(self.summary()))
+            self.executor.shutdown()
+        records = {}
+        for sample, future in list(self.futures.items()):
+            if future.done():
+                records[sample] = {'exit_code': future.result()}
+                del self.futures[sample]
+        return records
 
 
-def run_initial_refinement(processDir, projectDir, pdbDir, process_pipeline, refine_pipeline, analyseOnly):
-    for n, sample_folder in enumerate(sorted(glob.glob(os.path.join(processDir, '*')))):
-        sample = sample_folder.split('/')[len(sample_folder.split('/'))-1]
-        print('sample: ' + sample + '\n')
-        if analyseOnly:
-            analyse_process_directory(sample_folder, pdbDir)
+def execution_backend(name, jobs=None, array=False, throttle=None):
+    if name == 'local':
+        return local_backend(jobs)
+    return slurm_backend(array, throttle)
+
+
+def cell_distances(cells, other, block=256):
+    """ yields (row offset, distance block) for the distances between every cell in cells and every cell in other;
+        the distance is the largest relative difference of the cell axes or the largest angle difference in
+        units of 90 degrees, so 0.02 means 2% or 1.8 degrees; blocks keep memory flat for large campaigns
+    """
+    for start in range(0, len(cells), block):
+        rows = cells[start:start + block]
+        axes = np.abs(rows[:, None, :3] - other[None, :, :3]) / ((rows[:, None, :3] + other[None, :, :3]) / 2.0)
+        angles = np.abs(rows[:, None, 3:] - other[None, :, 3:]) / 90.0
+        yield start, np.maximum(axes.max(axis=2), angles.max(axis=2))
+
+
+def cell_roots(parent, idx):
+    # follows the parent pointers of all idx at once until every one has reached its root
+    roots = parent[idx]
+    while True:
+        up = parent[roots]
+        if np.array_equal(up, roots):
+            return roots
+        roots = up
+
+
+def cluster_unit_cells(cells, point_groups, tolerance=0.02):
+    """ single-linkage clustering of unit cells; two datasets are linked if they have the same point group
+        and their cell distance is below tolerance
+        clusters are merged with a union-find over the distance blocks: for every dataset, the roots of all
+        linked datasets are joined under the smallest one, so every distance is only computed once
+    """
+    cells = np.asarray(cells, dtype=float)
+    codes = np.unique(np.asarray(point_groups), return_inverse=True)[1]
+    parent = np.arange(len(cells))
+    block = 256
+    for start in range(0, len(cells), block):
+        # distances are symmetric, so every block is only compared with itself and the cells after it
+        distances = next(cell_distances(cells[start:start + block], cells[start:], block))[1]
+        linked = (distances < tolerance) & (codes[start:start + len(distances), None] == codes[None, start:])
+        for row in range(len(distances)):
+            roots = np.unique(cell_roots(parent, start + np.nonzero(linked[row])[0]))
+            if len(roots) > 1:
+                parent[roots] = roots[0]
+        # path compression, so that the next block finds the roots in one or two steps
+        parent = cell_roots(parent, np.arange(len(cells)))
+    # renumber clusters 0..n-1 by size, largest first
+    labels = cell_roots(parent, np.arange(len(cells)))
+    roots, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[inverse]
+
+
+def assign_references_by_cluster(results, pdbIndex, tolerance=0.02, reference_tolerance=0.1, cached=None):
+    """ clusters the candidate datasets of all samples by unit cell and matches every cluster once to the
+        reference PDB with the closest median cell (same point group); a sample belongs to the cluster of its
+        selected dataset; samples alone in their cluster and clusters without a matching reference are
+        flagged as outliers
+        cached maps samples that were not scanned again to their manifest entry; their candidate cells take
+        part in the clustering, so that clusters cover the whole campaign and not only the new samples
+        returns (cluster, outlier) for every cached sample
+    """
+    results = [r for r in results if r['unitcell']]
+    cached = dict((sample, entry) for sample, entry in (cached or {}).items() if entry.get('candidate_cells'))
+    samples = [r['sample'] for r in results] + sorted(cached)
+    candidate_cells = [r['candidate_cells'] for r in results] + [cached[sample]['candidate_cells']
+                                                                  for sample in sorted(cached)]
+    owner = []
+    cells = []
+    point_groups = []
+    selected = {}
+    for n, candidates in enumerate(candidate_cells):
+        for unitcell, point_group, is_selected in candidates:
+            if is_selected:
+                selected[n] = len(cells)
+            owner.append(n)
+            cells.append(unitcell)
+            point_groups.append(point_group)
+    if not cells:
+        return {}
+    cells = np.array(cells, dtype=float)
+    owner = np.array(owner)
+    labels = cluster_unit_cells(cells, point_groups, tolerance)
+    print('INFO: {0!s} datasets of {1!s} samples ({2!s} from previous runs) in {3!s} isomorphous clusters'.format(
+        len(cells), len(samples), len(cached), labels.max() + 1))
+    header = ['cluster', 'samples', 'datasets', 'point group', 'median cell', 'reference_pdb', 'cell distance']
+    table = []
+    assignments = {}
+    for cluster in range(labels.max() + 1):
+        datasets = np.nonzero(labels == cluster)[0]
+        members = [n for n in sorted(selected) if labels[selected[n]] == cluster]
+        point_group = point_groups[datasets[0]]
+        median = np.median(cells[datasets], axis=0)
+        reference = None
+        distance = None
+        references = pdbIndex.get(point_group, [])
+        if references:
+            reference_cells = np.array([r['unitcell'] for r in references], dtype=float)
+            start, distances = next(cell_distances(median[None, :], reference_cells))
+            best = int(np.argmin(distances[0]))
+            distance = float(distances[0, best])
+            if distance < reference_tolerance:
+                reference = references[best]
+        outlier = reference is None or (len(set(owner[datasets])) == 1 and len(samples) > 1)
+        for n in members:
+            if n >= len(results):
+                assignments[samples[n]] = (int(cluster), bool(outlier))
+                continue
+            results[n]['cluster'] = int(cluster)
+            results[n]['outlier'] = bool(outlier)
+            results[n]['pdb'] = reference['pdb'] if reference else None
+            results[n]['pdb_name'] = reference['pdb_name'] if reference else None
+            results[n]['diff'] = distance
+        table.append([cluster, len(members), len(datasets), point_group,
+                      ' '.join('{0:.1f}'.format(p) for p in median),
+                      reference['pdb_name'] if reference else None,
+                      round(distance, 3) if distance is not None else None])
+        if outlier and members:
+            print('WARNING: non-isomorphous outlier(s) in cluster {0!s}: {1!s}'.format(
+                cluster, ', '.join(samples[n] for n in members)))
+    print(tabulate(table, headers=header))
+    return assignments
+
+
+def init_scan_worker(cacheFile, profile=False):
+    global mtzCache, in_worker
+    mtzCache = mtz_header_cache(cacheFile)
+    in_worker = True
+    # forked workers inherit the statistics of the parent process
+    profiler.stats = {}
+    profiler.enabled = profile
+
+
+def scan_sample(sample_folder, pdbDir, pdbIndex, process_pipeline, analyseOnly, weights=None, cluster=False):
+    """ file discovery, MTZ analysis and reference matching for a single sample folder
+        there are no side effects on the project directory, so this can run in a worker process
+        with cluster=True the reference PDB is left to assign_references_by_cluster
+    """
+    result = {
+        'sample': os.path.basename(sample_folder),
+        'records': [],
+        'mtz': None,
+        'log': None,
+        'cif': None,
+        'pdb': None,
+        'diff': None,
+        'pdb_name': None,
+        'pipeline': None,
+        'selection_reason': None,
+        'unitcell': None,
+        'point_group': None,
+        'candidate_cells': [],
+        'folders': []
+    }
+    candidates, result['fs_calls'] = discover_sample(sample_folder, result['folders'])
+    # taken right after the walk, so that results written while the sample is processed are not missed
+    result['folder_mtimes'] = folder_mtimes(result['folders'])
+    if analyseOnly:
+        result['records'] = analyse_process_directory(sample_folder, pdbDir, pdbIndex, candidates)
+    else:
+        best, reason = select_best_dataset(candidates, process_pipeline, pdbIndex, weights)
+        if best:
+            pdb, diff, pdb_name = None, None, None
+            if not cluster:
+                pdb, diff, pdb_name = find_pdb_input_file(pdbDir, best['mtz'], pdbIndex)
+            mtz = mtz_info(best['mtz'])
+            result.update({'mtz': best['mtz'], 'log': best['log'], 'cif': best['cif'], 'pipeline': best['pipeline'],
+                           'selection_reason': reason, 'pdb': pdb, 'diff': diff, 'pdb_name': pdb_name,
+                           'unitcell': mtz['unitcell'], 'point_group': mtz['point_group']})
+            # cells of every candidate for unit cell clustering; the headers are cached from the ranking
+            for candidate in candidates:
+                if process_pipeline and process_pipeline != 'all' and candidate['pipeline'] != process_pipeline:
+                    continue
+                info = mtz_info(candidate['mtz'])
+                result['candidate_cells'].append([[float(p) for p in info['unitcell']], info['point_group'],
+                                                  candidate['mtz'] == best['mtz']])
+    result['mtz_cache'] = mtzCache.take_delta()
+    result['profile'] = profiler.take_delta() if in_worker else {}
+    return result
+
+
+def scan_samples(sample_folders, pdbDir, pdbIndex, process_pipeline, analyseOnly, jobs, weights=None,
+                 cluster=False):
+    """ yields scan results in the order of sample_folders
+        with jobs > 1 the samples are distributed over a process pool
+    """
+    scan = functools.partial(scan_sample, pdbDir=pdbDir, pdbIndex=pdbIndex,
+                             process_pipeline=process_pipeline, analyseOnly=analyseOnly, weights=weights,
+                             cluster=cluster)
+    if jobs > 1 and len(sample_folders) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_scan_worker,
+                                                    initargs=(mtzCache.cacheFile, profiler.enabled)) as executor:
+            chunksize = max(1, len(sample_folders) // (jobs * 4))
+            for result in executor.map(scan, sample_folders, chunksize=chunksize):
+                yield result
+    else:
+        for sample_folder in sample_folders:
+            yield scan(sample_folder)
+
+
+def stage_and_submit_sample(result, processDir, projectDir, refine_pipeline, manifest, backend, forced=False):
+    """ links the selected files into the project directory, writes the refinement script and hands it to
+        the execution backend; returns False if the selected MTZ file was already submitted in a previous run
+    """
+    sample = result['sample']
+    sample_folder = os.path.join(processDir, sample)
+    print('INFO: {0!s} - selected {1!s}'.format(sample, result['selection_reason']))
+    if not forced and manifest.same_mtz(sample, result['mtz']) and manifest.samples[sample].get('job_id') \
+            and manifest.samples[sample].get('exit_code') in (None, 0):
+        print('INFO: {0!s} - selected MTZ file has not changed; skipping'.format(sample))
+        manifest.record(sample, sample_folder_mtime=os.stat(sample_folder).st_mtime,
+                        folder_mtimes=result['folder_mtimes'], candidate_cells=result['candidate_cells'])
+        return False
+    create_sample_folder_in_project_dir(projectDir, sample, False)
+    link_files_to_project_folder(projectDir, sample, result['mtz'], result['log'], result['cif'],
+                                 overwrite=sample in manifest.samples or forced)
+    prepare_init_refine_script(projectDir, sample, result['pdb'], refine_pipeline, backend)
+    if stager.dry_run:
+        print('dry-run: submit {0!s} job for {1!s} with {2!s} backend'.format(refine_pipeline, sample, backend.name))
+        return True
+    job_id = backend.submit(projectDir, sample, refine_pipeline)
+    manifest.record(sample,
+                    sample_folder_mtime=os.stat(sample_folder).st_mtime,
+                    folder_mtimes=result['folder_mtimes'],
+                    candidate_cells=result['candidate_cells'],
+                    mtz=result['mtz'],
+                    pipeline=result['pipeline'],
+                    selection_reason=result['selection_reason'],
+                    mtz_mtime=os.stat(result['mtz']).st_mtime,
+                    reference_pdb=result['pdb'],
+                    script=os.path.join(projectDir, sample, '{0!s}.sh'.format(refine_pipeline)),
+                    backend=backend.name,
+                    job_id=job_id,
+                    exit_code=None)
+    manifest.save()
+    return True
+
+
+def run_initial_refinement(processDir, projectDir, pdbDir, process_pipeline, refine_pipeline, analyseOnly, jobs=1,
+                           force=None, backend=None, writer=None, weights=None, cluster_tolerance=None):
+    pdbIndex = build_reference_pdb_index(pdbDir)
+    sample_folders = sorted(glob.glob(os.path.join(processDir, '*')))
+    force = force or []
+    manifest = None
+    if backend is None:
+        backend = slurm_backend()
+    if not analyseOnly:
+        manifest = project_manifest(projectDir)
+        unchanged = [s for s in sample_folders
+                     if os.path.basename(s) not in force and 'all' not in force
+                     and manifest.is_up_to_date(os.path.basename(s), s)]
+        sample_folders = [s for s in sample_folders if s not in unchanged]
+        unchanged = [os.path.basename(s) for s in unchanged]
+        print('INFO: {0!s} samples unchanged since last run; {1!s} samples to process'.format(
+            len(unchanged), len(sample_folders)))
+    results = scan_samples(sample_folders, pdbDir, pdbIndex, process_pipeline, analyseOnly, jobs, weights,
+                           cluster=bool(cluster_tolerance))
+    if cluster_tolerance and not analyseOnly:
+        # references are assigned per cluster, so all samples need to be scanned before anything is submitted
+        results = list(results)
+        cached = dict((sample, manifest.samples[sample]) for sample in unchanged)
+        for sample, (cluster, outlier) in assign_references_by_cluster(results, pdbIndex, cluster_tolerance,
+                                                                       cached=cached).items():
+            manifest.record(sample, cluster=cluster, outlier=outlier)
+    for result in results:
+        mtzCache.merge_delta(result['mtz_cache'])
+        profiler.merge_delta(result['profile'])
+        sample = result['sample']
+        print('sample: ' + sample + '\n', file=messages)
+        print('INFO: {0!s} filesystem calls while scanning sample folder'.format(result['fs_calls']), file=messages)
+        if analyseOnly and writer:
+            writer.write(result['records'])
+        elif analyseOnly:
+            print_analysis_table(result['records'])
+        elif result['mtz'] and cluster_tolerance and result['pdb'] is None:
+            print('WARNING: {0!s} - no reference PDB for unit cell cluster {1!s}; not submitting'.format(
+                sample, result['cluster']))
+            manifest.record(sample, cluster=result['cluster'], outlier=True,
+                            candidate_cells=result['candidate_cells'])
+            manifest.save()
+        elif result['mtz']:
+            forced = sample in force or 'all' in force
+            if cluster_tolerance:
+                manifest.record(sample, cluster=result['cluster'], outlier=result['outlier'])
+            stage_and_submit_sample(result, processDir, projectDir, refine_pipeline, manifest, backend, forced)
+    if writer:
+        writer.summary()
+    if manifest:
+        manifest.save()
+        for sample, fields in backend.finish(projectDir, refine_pipeline).items():
+            manifest.record(sample, **fields)
+        manifest.save()
+
+
+class directory_watcher(object):
+    """ waits for changes in a set of directories
+        uses inotify (through ctypes) where it is available and falls back to polling directory mtimes
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    inotify_mask = 0x00000002 | 0x00000008 | 0x00000080 | 0x00000100 | 0x00000200
+
+    def __init__(self):
+        self.fd = None
+        self.watches = {}
+        self.mtimes = {}
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK)
+            if fd >= 0:
+                self.fd = fd
+        except (OSError, AttributeError, TypeError):
+            pass
+        print('INFO: watching directories with {0!s}'.format('inotify' if self.fd is not None else 'polling'))
+
+    def add(self, path):
+        if path in self.mtimes:
+            return
+        try:
+            self.mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            return
+        if self.fd is not None:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.inotify_mask)
+            if wd >= 0:
+                self.watches[wd] = path
+
+    def wait(self, timeout):
+        """ returns the set of watched directories that changed within timeout seconds """
+        changed = set()
+        if self.fd is not None:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if ready:
+                # give writers a moment, then drain all pending events at once
+                time.sleep(1)
+                data = os.read(self.fd, 1 << 16)
+                offset = 0
+                while offset + 16 <= len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    offset += 16 + length
+                    if wd in self.watches:
+                        changed.add(self.watches[wd])
         else:
-#            create_sample_folder_in_project_dir(projectDir, sample, analyseOnly)
-            mtz, log, cif = find_autoproc_results(sample_folder, process_pipeline)
-            if mtz:
-                create_sample_folder_in_project_dir(projectDir, sample, analyseOnly)
-                link_files_to_project_folder(projectDir, sample, mtz, log, cif)
-                pdb, diff, pdb_name = find_pdb_input_file(pdbDir, mtz)
-                prepare_init_refine_script(projectDir, sample, pdb, refine_pipeline)
-                submit_init_refine_script(projectDir, sample, refine_pipeline)
+            time.sleep(timeout)
+        # inotify does not see changes made by other NFS clients, so mtimes are always compared as well
+        for path, mtime in list(self.mtimes.items()):
+            try:
+                current = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if current != mtime:
+                self.mtimes[path] = current
+                changed.add(path)
+        return changed
+
+
+def result_signature(result):
+    signature = []
+    for f in [result['mtz'], result['log'], result['cif']]:
+        try:
+            stat = os.stat(f) if f else None
+        except OSError:
+            stat = None
+        signature.append((f, stat.st_size, stat.st_mtime) if stat else (f, None, None))
+    return signature
+
 
+def watch_process_directory(processDir, projectDir, pdbDir, process_pipeline, refine_pipeline, interval=60, settle=120,
+                            backend=None, weights=None):
+    """ keeps monitoring processDir and submits the initial refinement of a sample as soon as its
+        auto-processing results are complete; results count as complete once the selected MTZ, log and
+        cif files have not changed for at least settle seconds
+    """
+    pdbIndex = build_reference_pdb_index(pdbDir)
+    manifest = project_manifest(projectDir)
+    if backend is None:
+        backend = slurm_backend()
+    watcher = directory_watcher()
+    watcher.add(processDir)
+    open_samples = set()
+    pending = {}
+    # watched directory -> sample folder; only samples with a changed directory are scanned again
+    owners = {}
+    dirty = set()
+
+    def watch(path, sample_folder):
+        owners[path] = sample_folder
+        watcher.add(path)
+
+    def refresh_samples():
+        for sample_folder in glob.glob(os.path.join(processDir, '*')):
+            if sample_folder in open_samples or not os.path.isdir(sample_folder):
+                continue
+            if not manifest.is_up_to_date(os.path.basename(sample_folder), sample_folder):
+                open_samples.add(sample_folder)
+                dirty.add(sample_folder)
+                watch(sample_folder, sample_folder)
+
+    def flush_backend(wait):
+        # array jobs are submitted and exit codes of local jobs collected at the end of every pass
+        records = backend.finish(projectDir, refine_pipeline, wait=wait)
+        for sample, fields in records.items():
+            manifest.record(sample, **fields)
+        if records:
+            manifest.save()
+
+    refresh_samples()
+    print('INFO: watching {0!s}; {1!s} samples waiting for results'.format(processDir, len(open_samples)))
+    try:
+        while True:
+            changed = watcher.wait(interval if not (pending or dirty) else min(interval, settle))
+            if processDir in changed:
+                refresh_samples()
+            for path in changed:
+                if path not in owners:
+                    continue
+                sample_folder = owners[path]
+                # e.g. a new pipeline run for a sample that was already submitted
+                if sample_folder not in open_samples and \
+                        not manifest.is_up_to_date(os.path.basename(sample_folder), sample_folder):
+                    open_samples.add(sample_folder)
+                dirty.add(sample_folder)
+            # samples whose results are settling are checked again even if nothing changed
+            dirty.update(os.path.join(processDir, sample) for sample in pending)
+            scan = sorted(dirty & open_samples)
+            dirty.clear()
+            for sample_folder in scan:
+                sample = os.path.basename(sample_folder)
+                try:
+                    result = scan_sample(sample_folder, pdbDir, pdbIndex, process_pipeline, False, weights)
+                except (RuntimeError, OSError, ValueError) as e:
+                    # most likely an MTZ file that is still being written
+                    print('INFO: {0!s} - cannot read results yet ({1!s})'.format(sample, e))
+                    pending.pop(sample, None)
+                    dirty.add(sample_folder)
+                    continue
+                mtzCache.merge_delta(result['mtz_cache'])
+                # every pipeline folder found so far, so that new runs and files inside them are noticed
+                for folder in result['folders']:
+                    watch(folder, sample_folder)
+                if not result['mtz']:
+                    continue
+                signature = result_signature(result)
+                now = time.time()
+                if sample not in pending or pending[sample][0] != signature:
+                    pending[sample] = [signature, now]
+                    continue
+                if now - pending[sample][1] < settle:
+                    continue
+                print('sample: ' + sample + '\n')
+                stage_and_submit_sample(result, processDir, projectDir, refine_pipeline, manifest, backend)
+                open_samples.discard(sample_folder)
+                del pending[sample]
+            flush_backend(False)
+            mtzCache.save()
+    except KeyboardInterrupt:
+        print('INFO: submitting pending array jobs and waiting for running local jobs')
+        flush_backend(True)
+        raise
 
 
 def usage():
@@ -232,13 +1415,56 @@ def usage():
         '    directory with pdb files\n'
         '    note: pdb files not to have valid CRYST1 card'
         '--autoproc, -a\n'
-        '    auto-processing pipeline (e.g. autooproc)\n'
+        '    auto-processing pipeline (autoproc, staraniso or dials); by default the best dataset\n'
+        '    of all pipelines is selected\n'
+        '--weights\n'
+        '    weights for selecting the best dataset, e.g. "resolution=1,cell=1,completeness=0.5,isigma=0.5"\n'
         '--refine, -r\n'
         '    initial refinement pipeline (e.g. dimple)\n'
         '--overwrite, -o\n'
         '    flag to overwrite files\n'
         '--analyse, -y\n'
         '    flag to analyse process directory, without file operations\n'
+        '--format\n'
+        '    output format of --analyse: table (default), csv or jsonl; csv and jsonl records are written to\n'
+        '    stdout as soon as a sample is analysed, all other messages go to stderr\n'
+        '--cluster\n'
+        '    cluster the datasets of all samples by unit cell, including samples from previous runs, and assign\n'
+        '    one reference PDB per cluster; a sample belongs to the cluster of its selected dataset; samples\n'
+        '    without a matching reference are flagged as outliers and not submitted\n'
+        '--cluster-tolerance\n'
+        '    largest cell difference within a cluster as fraction of the cell axes (angles: x 90 degrees),\n'
+        '    implies --cluster; default: 0.02\n'
+        '--dry-run\n'
+        '    only print which folders, links and scripts would be created and which jobs would be submitted\n'
+        '--profile\n'
+        '    print wall time, calls, bytes read and filesystem calls for every stage at the end of the run\n'
+        '--profile-output\n'
+        '    also write cProfile statistics to this file (e.g. for snakeviz or flameprof)\n'
+        '--cache, -c\n'
+        '    MTZ header cache file (default: {0!s})\n'.format(default_mtz_cache_file()) +
+        '--no-cache\n'
+        '    do not read or write the MTZ header cache\n'
+        '--jobs, -j\n'
+        '    number of worker processes for scanning sample folders (default: 1)\n'
+        '--watch, -w\n'
+        '    keep monitoring the process directory and submit initial refinement jobs as soon as\n'
+        '    new auto-processing results are complete\n'
+        '--interval\n'
+        '    seconds between checks of the process directory in watch mode (default: 60)\n'
+        '--settle\n'
+        '    seconds that result files must stay unchanged before they are used in watch mode (default: 120)\n'
+        '--backend, -b\n'
+        '    where to run the initial refinement: slurm (default) or local\n'
+        '--local-jobs\n'
+        '    maximum number of concurrent refinement jobs with the local backend (default: number of cores)\n'
+        '--array\n'
+        '    submit all initial refinement jobs as a single Slurm job array\n'
+        '--throttle\n'
+        '    maximum number of array tasks running at the same time (sbatch --array=...%N)\n'
+        '--force, -f\n'
+        '    comma separated list of samples to process again, even if they did not change\n'
+        '    since the last run (use "all" for every sample)\n'
     )
     print(usage)
 
@@ -252,10 +1478,30 @@ def main(argv):
     refine_pipeline = None
     overwrite = False
     analyseOnly = False
+    cacheFile = default_mtz_cache_file()
+    jobs = 1
+    force = []
+    watch = False
+    interval = 60
+    settle = 120
+    array = False
+    throttle = None
+    backend_name = 'slurm'
+    output_format = 'table'
+    weights = default_ranking_weights()
+    profileOutput = None
+    cluster_tolerance = None
+    local_jobs = None
+    dry_run = False
 
     try:
-        opts, args = getopt.getopt(argv,"i:o:p:a:r:hy",["input=", "output=", "pdbdir=",
-                                                         "autoproc=", "refine=", "analyse"])
+        opts, args = getopt.getopt(argv,"i:o:p:a:r:c:j:f:b:hyw",["input=", "output=", "pdbdir=",
+                                                         "autoproc=", "refine=", "analyse",
+                                                         "cache=", "no-cache", "jobs=", "force=",
+                                                         "watch", "interval=", "settle=", "array", "throttle=",
+                                                         "backend=", "local-jobs=", "format=", "weights=",
+                                                         "profile", "profile-output=", "cluster",
+                                                         "cluster-tolerance=", "dry-run"])
     except getopt.GetoptError:
         print('foehfuie')
 #        usage()
@@ -277,10 +1523,96 @@ def main(argv):
             refine_pipeline = arg
         elif opt in ("-y", "--analyse"):
             analyseOnly = True
+        elif opt in ("-c", "--cache"):
+            cacheFile = arg
+        elif opt == "--no-cache":
+            cacheFile = None
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt in ("-f", "--force"):
+            force = arg.split(',')
+        elif opt in ("-w", "--watch"):
+            watch = True
+        elif opt == "--interval":
+            interval = int(arg)
+        elif opt == "--settle":
+            settle = int(arg)
+        elif opt == "--array":
+            array = True
+        elif opt == "--throttle":
+            throttle = int(arg)
+        elif opt in ("-b", "--backend"):
+            backend_name = arg
+        elif opt == "--local-jobs":
+            local_jobs = int(arg)
+        elif opt == "--format":
+            output_format = arg
+        elif opt == "--cluster":
+            cluster_tolerance = cluster_tolerance or 0.02
+        elif opt == "--cluster-tolerance":
+            cluster_tolerance = float(arg)
+        elif opt == "--dry-run":
+            dry_run = True
+        elif opt == "--profile":
+            profiler.enabled = True
+        elif opt == "--profile-output":
+            profiler.enabled = True
+            profileOutput = arg
+        elif opt == "--weights":
+            for item in arg.split(','):
+                key, sep, value = item.partition('=')
+                key = key.strip()
+                if not sep or key not in default_ranking_weights():
+                    print('ERROR: invalid ranking weight "{0!s}"; expected <metric>=<weight> with metric one of: '
+                          '{1!s}'.format(item, ', '.join(sorted(default_ranking_weights()))))
+                    usage()
+                    sys.exit(2)
+                try:
+                    weights[key] = float(value)
+                except ValueError:
+                    print('ERROR: weight for {0!s} is not a number: "{1!s}"'.format(key, value))
+                    usage()
+                    sys.exit(2)
 
+    writer = None
+    if analyseOnly and output_format in ('csv', 'jsonl'):
+        # keep stdout clean for the records; set before anything below can print a warning
+        writer = analysis_writer(output_format, sys.stdout)
+        global messages
+        messages = sys.stderr
 
+    global mtzCache
+    mtzCache = mtz_header_cache(cacheFile)
+    global stager
+    stager = file_stager(dry_run)
+
+    backend = execution_backend(backend_name, local_jobs, array, throttle)
+
+    if watch:
+        try:
+            watch_process_directory(processDir, projectDir, pdbDir, process_pipeline, refine_pipeline, interval, settle,
+                                    backend, weights)
+        except KeyboardInterrupt:
+            mtzCache.save()
+            print('INFO: stopped watching {0!s}'.format(processDir))
+        return
+
+    cprofile = None
+    if profileOutput:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
 #    try:
-    run_initial_refinement(processDir, projectDir, pdbDir, process_pipeline, refine_pipeline, analyseOnly)
+    run_initial_refinement(processDir, projectDir, pdbDir, process_pipeline, refine_pipeline, analyseOnly, jobs, force, backend, writer, weights, cluster_tolerance)
+    mtzCache.save()
+    print('INFO: MTZ header cache: {0!s} hits, {1!s} misses'.format(mtzCache.hits, mtzCache.misses), file=messages)
+    if not analyseOnly:
+        print('INFO: {0!s}'.format(stager.summary()))
+    if cprofile:
+        cprofile.disable()
+        cprofile.dump_stats(profileOutput)
+        print('INFO: cProfile statistics written to {0!s}'.format(profileOutput), file=messages)
+    if profiler.enabled:
+        profiler.summary()
 #    except TypeError:
 #        print('kkkkkk')
 #        usage()